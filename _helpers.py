@@ -1,144 +1,777 @@
+import contextlib
 import json
 import os.path
+import sys
+import time
+import typing as t
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from pathlib import Path
 
+import git
+from sqlalchemy import Row
+
+from archive import open_archive
 from configs import configs
-from git_helper import git_helper
-from hedgedoc import Note, create_notes, delete_notes, hedgedoc
-from utils import exit_with_error
+from git_helper import HistoryWriter, IndexEntry, NoteIndex, UploadManifest, git_helper
+from hedgedoc import Note, User, create_notes, delete_notes, hedgedoc, update_notes
+from note_diff import EMPTY_HASH, ChangeType, NoteDiff, NoteRecord, Resolution, diff_notes, resolve
+from sync_plan import SyncPlan
+from sync_state import SyncState
+from utils import exit_with_error, hash_content, is_initialized, submit, timed
+
+
+METADATA_DIR = '.hedge2git/'  # reserved, i.e. never written a note into, see gen_rel_path
+USERS_DIR = f'{METADATA_DIR}users/'  # the notes of many users synced at once are written under it
+
+
+def ls_notes(prefix: str = '') -> dict[str, str]:
+    """Return the blob hash of each note in the repository under a directory, keyed by its relative path.
+
+    The metadata directory is left out, and so are the notes of the users pushed at once under it.
+    """
+    return {
+        rel_path: digest for rel_path, digest in git_helper.ls_files().items()
+        if rel_path.startswith(prefix) and rel_path.endswith('.md')
+        and not rel_path.startswith(prefix + METADATA_DIR)
+    }
+
+
+@timed('scan git notes')
+def scan_git_notes(index: NoteIndex) -> dict[str, IndexEntry]:
+    """Return the metadata of the notes in the repository, reading only the files the index is stale for.
+
+    The files are listed from the tree of HEAD along with their blob hashes, i.e. without opening them, and the
+    files read are cached locally until they change, so a file changed without updating the index is read once.
+    """
+    files = ls_notes()
+    for rel_path in [rel_path for rel_path in index.entries if rel_path not in files]:
+        index.remove(rel_path)
+
+    cache = NoteIndex.load_cache()
+    notes = {}
+    for rel_path, digest in files.items():
+        if (entry := index.get(rel_path, digest)) is None:
+            if (entry := cache.get(rel_path, digest)) is None:
+                content = git_helper.read_text(rel_path)
+                title = Path(rel_path).stem
+                entry = {
+                    'id': index.entries[rel_path]['id'] if rel_path in index.entries else '',
+                    'alias': Note.get_alias(title=title, content=content),
+                    'title': title,
+                    'tags': Note.get_tags(content),
+                    'hash': digest,
+                }
+                cache.set(rel_path, entry)
+            index.set(rel_path, entry)
+        notes[rel_path] = entry
+
+    if cache.changed:
+        NoteIndex(notes).save_cache()  # the files gone are dropped as well
+    return notes
+
+
+def gen_rel_path(tags: list[str], title: str, prefix: str = '') -> str:
+    rel_path = (Path(os.path.sep.join(tags)) / f'{title}.md').as_posix()
+    if rel_path.startswith(METADATA_DIR):  # e.g. tagged `.hedge2git`
+        rel_path = f'_{rel_path}'
+    return prefix + rel_path
+
+
+def get_user_prefix(user: User) -> str:
+    """Return the directory the notes of a user are written under when syncing many users at once."""
+    return f'{USERS_DIR}{user.email or user.id}/'
 
 
-def validate(**actions: str | bool | None) -> None:
-    resp = hedgedoc.GET('me')
-    status = json.loads(resp.text)['status']
-    if status == 'forbidden':
-        exit_with_error('Invalid email or password')
+def gen_hedgedoc_notes(owner: User, state: SyncState,
+                       rows: dict[str, Row] | None = None) -> t.Iterator[NoteRecord]:
+    """Yield the notes of a user, loading the content of the ones updated since the last push only.
 
-    if actions['pull'] and actions['push'] is not None:
-        exit_with_error("Got both 'pull' and 'push'")
+    The rows listed (without the contents) are collected into `rows` by their ids, if given.
+    """
+    stale_notes: dict[uuid.UUID, tuple[str, str]] = {}  # the title and alias only
+    for note in hedgedoc.iter_notes(owner=owner):
+        if rows is not None:
+            rows[str(note.id)] = note
+        if prev := state.get(str(note.id), note.updated_at):
+            yield NoteRecord(prev['path'], prev['hash'], str(note.id), note.alias or '', tuple(prev['tags']))
+        else:
+            stale_notes[note.id] = note.title, note.alias or ''
+    for note_id, content in hedgedoc.get_contents(stale_notes):
+        title, alias = stale_notes[note_id]
+        tags = Note.get_tags(content or '')
+        yield NoteRecord(gen_rel_path(tags, title), hash_content(content or ''), str(note_id), alias, tuple(tags))
 
 
-def pull(*, overwrite: bool, dry_run: bool) -> None:
-    """Update Hedgedoc notes from the Git repository."""
+def pull(*, overwrite: bool, dry_run: bool, plan: SyncPlan | None = None) -> None:
+    """Update Hedgedoc notes from the Git repository, or record the changes into `plan` (implying `dry_run`)."""
     git_helper.pull()
 
     # fetch remote notes
-    git_notes = []
-    for path in git_helper.repo_path.rglob('*.md'):
-        if set(configs['NOTE__DO_NOT_PULL']).intersection(Note.get_tags(path.read_text(encoding='utf-8'))):
-            continue
-        git_notes.append(path)
-    git_notes.sort()
-
-    def gen_path(note: Note):
-        return git_helper.repo_path / os.path.sep.join(note.tags) / f'{note.title}.md'
-
-    # collect local notes (without writing them)
-    hedgedoc_notes = []
-    for note in hedgedoc.get_notes(owner=hedgedoc.get_current_user()):
-        hedgedoc_notes.append(note)
-    hedgedoc_notes.sort(key=lambda note: gen_path(note))
-
-    # compare notes
-    i = j = 0
-    new_notes: list[Path] = []  # notes to be created in the database
-    deprecated_notes: list[Note] = []  # notes to be deleted in the database
-    while i < len(git_notes) and j < len(hedgedoc_notes):
-        hedgedoc_note = gen_path(hedgedoc_notes[j])
-        if git_notes[i] < hedgedoc_note:
-            new_notes.append(git_notes[i])
-            i += 1
-        elif git_notes[i] > hedgedoc_note:
-            deprecated_notes.append(hedgedoc_notes[j])
-            j += 1
-        else:
-            i += 1
-            j += 1
+    git_notes = (
+        NoteRecord(rel_path, entry['hash'], entry['id'], entry['alias'], tuple(entry['tags']))
+        for rel_path, entry in scan_git_notes(NoteIndex.load(git_helper)).items()
+        if not set(configs['NOTE__DO_NOT_PULL']).intersection(entry['tags'])
+    )
 
-    while i < len(git_notes):
-        new_notes.append(git_notes[i])
-        i += 1
+    # collect local notes (without writing them), loading the content of the ones updated since the last push only
+    owner = hedgedoc.get_current_user()
+    state = SyncState.load(str(owner.id))
 
-    while j < len(hedgedoc_notes):
-        deprecated_notes.append(hedgedoc_notes[j])
-        j += 1
+    # compare notes, streaming them through the diff
+    with timed('diff'):
+        new_notes: list[Path] = []  # notes to be created in the database
+        modified_notes: dict[uuid.UUID, Path] = {}  # notes to be updated in the database
+        deprecated_ids: list[uuid.UUID] = []  # notes to be deleted in the database
+        for change in diff_notes(git_notes, gen_hedgedoc_notes(owner, state)):
+            if change.type == ChangeType.added:
+                new_notes.append(Path(change.source.path))
+                if plan is not None:
+                    plan.creates.append({'path': change.source.path, 'hash': change.source.hash})
+            elif change.type == ChangeType.removed:
+                deprecated_ids.append(uuid.UUID(change.target.id))
+                if plan is not None and overwrite:
+                    plan.deletes.append({
+                        'id': change.target.id, 'path': change.target.path, 'base': change.target.hash,
+                    })
+            elif change.content_changed:  # a note moved without changes needs nothing in the database
+                modified_notes[uuid.UUID(change.target.id)] = Path(change.source.path)
+                if plan is not None and overwrite:
+                    plan.updates.append({
+                        'id': change.target.id, 'path': change.source.path,
+                        'hash': change.source.hash, 'base': change.target.hash,
+                    })
+        new_notes.sort()
+        deprecated_notes = hedgedoc.get_notes(ids=deprecated_ids) if deprecated_ids else []
 
-    # sync notes
-    create_notes(new_notes, dry_run)
+    aliases = sync_notes(new_notes, modified_notes, deprecated_notes, overwrite=overwrite, dry_run=dry_run)
+    if plan is not None:
+        plan.creates.sort(key=lambda create: create['path'])
+        plan.aliases = [
+            {'id': str(note_id), 'alias': alias, 'new_alias': new_alias}
+            for note_id, (alias, new_alias) in aliases.items()
+        ]
+
+
+def sync_notes(new_notes: list[Path], modified_notes: dict[uuid.UUID, Path], deprecated_notes: list[Note], *,
+               overwrite: bool, dry_run: bool) -> dict[uuid.UUID, tuple[str | None, str]]:
+    """Create, update and delete (or else re-alias) Hedgedoc notes from the files in the Git repository.
+
+    Return the notes re-aliased, see Hedgedoc.refresh_alias.
+    """
+    # upload the files the notes refer to unless the server has them already (e.g. a new server)
+    manifest = UploadManifest.load(git_helper)
+    upload_names: dict[str, str] = {}  # the names of the files on the server by the names the notes refer to
+    uploaded_names: dict[str, str] = {}  # the names of the files uploaded keyed by their paths in the repository
+
+    def restore_upload(name: str) -> str:
+        if (upload_path := manifest.get(name)) is None or dry_run or hedgedoc.has_upload(name):
+            return name
+        if upload_path not in uploaded_names:
+            uploaded_names[upload_path] = hedgedoc.add_upload(name, git_helper.read_bytes(upload_path))
+        return uploaded_names[upload_path]
+
+    def read_text(rel_path: str) -> str:
+        content = git_helper.read_text(rel_path)
+        for name in hedgedoc.get_upload_names(content):
+            if name not in upload_names:
+                upload_names[name] = restore_upload(name)
+            content = content.replace(f'uploads/{name}', f'uploads/{upload_names[name]}')
+        return content
+
+    create_notes(new_notes, dry_run, read_text=read_text)
     if overwrite:
+        update_notes(modified_notes, dry_run, read_text=read_text)
         delete_notes(deprecated_notes, dry_run)
-    else:
-        hedgedoc.refresh_alias(deprecated_notes, dry_run)
+        return {}
+    return hedgedoc.refresh_alias(deprecated_notes, dry_run)
 
 
-def push(comment: str, *, overwrite: bool, dry_run: bool) -> None:
-    """Apply changes from Hedgedoc to the Git repository."""
+def push(comment: str, *, overwrite: bool, dry_run: bool, plan: SyncPlan | None = None) -> None:
+    """Apply changes from Hedgedoc to the Git repository, or record them into `plan` (implying `dry_run`)."""
     git_helper.pull()
-    hedgedoc.refresh_alias(dry_run=dry_run)
+    notes, state = push_notes(hedgedoc.get_current_user(), overwrite=overwrite, dry_run=dry_run, plan=plan)
+    if not dry_run:
+        commit(comment, notes, [state])
 
-    # fetch remote notes
-    git_notes = []
-    for path in git_helper.repo_path.rglob('*.md'):
-        rel_path = path.relative_to(git_helper.repo_path)
-        git_notes.append(rel_path)
-    git_notes.sort()
-
-    # collect local notes (without writing them)
-    def gen_rel_path(note: Note):
-        return Path(os.path.sep.join(note.tags)) / f'{note.title}.md'
-
-    local_notes = []
-    for note in hedgedoc.get_notes(owner=hedgedoc.get_current_user()):
-        if not note.title or not note.content:  # type: ignore
-            continue
-        if set(configs['NOTE__DO_NOT_PUSH']).intersection(Note.get_tags(note.content)):  # type: ignore
-            continue
-        local_notes.append(note)
-    local_notes.sort(key=gen_rel_path)
-
-    # compare notes
-    i = j = 0
-    new_notes: list[Note] = []  # notes to be uploaded to the remote
-    deprecated_notes: list[Path] = []  # notes to be removed from the remote
-    while i < len(git_notes) and j < len(local_notes):
-        local_note = gen_rel_path(local_notes[j])
-        if git_notes[i] < local_note:
-            deprecated_notes.append(git_notes[i])
-            i += 1
-        elif git_notes[i] > local_note:
-            new_notes.append(local_notes[j])
-            j += 1
-        else:
-            i += 1
-            j += 1
 
-    while i < len(git_notes):
-        deprecated_notes.append(git_notes[i])
-        i += 1
+def push_users(comment: str, emails: list[str] | None, *, overwrite: bool, dry_run: bool) -> None:
+    """Apply changes from Hedgedoc to the Git repository for many (by default all) users in a single commit.
+
+    The notes of each user are written under their own directory, see get_user_prefix.
+    """
+    git_helper.pull()
+
+    def push_user(user: User) -> tuple[list[str], SyncState]:
+        try:
+            return push_notes(user, prefix=get_user_prefix(user), overwrite=overwrite, dry_run=dry_run)
+        finally:
+            hedgedoc.session.remove()  # the session of the worker thread
+
+    with ThreadPoolExecutor(configs['USER_CONCURRENCY']) as executor:
+        futures = [submit(executor, push_user, user) for user in hedgedoc.get_users(emails)]
+        results = [future.result() for future in futures]
+    if not dry_run:
+        commit(comment, [note for notes, _ in results for note in notes], [state for _, state in results])
+
+
+def commit(comment: str, notes: list[str], states: list[SyncState]) -> None:
+    if notes:
+        git_helper.push(comment, notes, force=True)
+    head = git_helper.head()
+    for state in states:
+        state.save(head)
+
+
+def push_notes(owner: User, prefix: str = '', *, overwrite: bool, dry_run: bool,
+               plan: SyncPlan | None = None) -> tuple[list[str], SyncState]:
+    """Write the changes of the notes of a user under a directory without committing them.
+
+    Return the files written or removed, and the sync state to be saved once they are committed. With a `plan`,
+    the changes are recorded into it instead (`dry_run` must be set).
+    """
+    # resume from the last sync if the repository has not changed since then
+    state = SyncState.load(str(owner.id), prefix)
+    prev_notes = dict(state.notes)
+    if incremental := state.commit is not None and state.commit == git_helper.head():
+        git_files = {note['path']: note['hash'] for note in state.notes.values()}
+    else:  # fetch remote notes
+        state.watermark = None
+        git_files = ls_notes(prefix)
+    # the notes not updated since the last sync have been re-aliased then
+    aliases = hedgedoc.refresh_alias(dry_run=dry_run, owner=owner, updated_since=state.watermark)
+    index = NoteIndex.load(git_helper, prefix)
+
+    # identify the remote notes by the sync state, or by the index for the ones pushed from elsewhere
+    note_ids = {note['path']: note_id for note_id, note in state.notes.items()}
+
+    def gen_record(rel_path: str, digest: str) -> NoteRecord:
+        entry = index.entries.get(rel_path)
+        note_id = note_ids.get(rel_path) or (entry['id'] if entry else '')
+        return NoteRecord(rel_path, digest, note_id, entry['alias'] if entry else '')
+
+    # compared in memory (unlike pull, see diff_notes), so that the memory grows with the number of notes
+    git_notes = NoteDiff(gen_record(rel_path, digest) for rel_path, digest in git_files.items())
 
-    while j < len(local_notes):
-        new_notes.append(local_notes[j])
-        j += 1
+    # collect local notes changed since the last sync (without loading the content of the unchanged ones)
+    with timed('list notes'):
+        new_notes: set[str] = set()  # notes to be uploaded to the remote
+        deprecated_notes: set[str] = set()  # notes to be removed from the remote
+        listed_notes: set[str] = set()
+        upload_names: set[str] = set()  # the files uploaded to Hedgedoc the notes written refer to
+        stale_notes: dict[uuid.UUID, Row] = {}
+        for note in hedgedoc.iter_notes(owner=owner, updated_since=state.watermark):
+            listed_notes.add(note_id := str(note.id))
+            if not note.title:
+                continue
+            prev = state.get(note_id, note.updated_at)
+            if prev is None or prev['hash'] != git_files.get(prev['path']):
+                stale_notes[note.id] = note
+            else:
+                git_notes.match(NoteRecord(prev['path'], prev['hash'], note_id, note.alias or ''))
+                index.set(prev['path'], {
+                    'id': note_id,
+                    'alias': note.alias or Note.get_alias(title=note.title, tags=prev['tags']),
+                    'title': note.title,
+                    'tags': prev['tags'],
+                    'hash': prev['hash'],
+                })
 
     # sync notes
-    print('Uploading notes...')
-    for note in new_notes:
-        alias = Note.get_alias(content=note.content)  # type: ignore
-        print(f'\t{note.title} ({alias})')
-        if not dry_run:
-            path = git_helper.repo_path / gen_rel_path(note)
-            path.parent.mkdir(parents=True, exist_ok=True)
-            path.write_text(str(note.content), encoding='utf-8')
+    def gen_uploads() -> t.Iterator[tuple[str, str]]:
+        for note_id, content in hedgedoc.get_contents(stale_notes):
+            note = stale_notes[note_id]
+            tags = Note.get_tags(content)
+            if not content or set(configs['NOTE__DO_NOT_PUSH']).intersection(tags):
+                continue
 
+            rel_path = gen_rel_path(tags, note.title, prefix)
+            digest = hash_content(content)
+            upload_names.update(hedgedoc.get_upload_names(content))
+            entry: IndexEntry = {
+                'id': str(note_id),
+                'alias': aliases[note_id][1] if note_id in aliases else note.alias or Note.get_alias(
+                    title=note.title, tags=tags,
+                ),
+                'title': note.title,
+                'tags': tags,
+                'hash': digest,
+            }
+            change = git_notes.match(NoteRecord(rel_path, digest, str(note_id), note.alias or ''))
+            if change.type == ChangeType.renamed:  # re-tagged or re-titled
+                deprecated_notes.add(change.target.path)
+                print(f'\t{note.title} ({change.target.path} -> {rel_path})')
+            elif change.type != ChangeType.unchanged:
+                print(f'\t{note.title} ({Note.get_alias(content=content)})')
+            if change.type != ChangeType.unchanged:
+                new_notes.add(rel_path)
+                if plan is not None:
+                    plan.writes.append({
+                        'path': rel_path, 'hash': digest, 'base': git_files.get(rel_path), 'entry': entry,
+                    })
+                yield rel_path, content
+
+            state.update(str(note_id), rel_path, tags, digest, note.updated_at)
+            index.set(rel_path, entry)
+
+    with timed('upload'):
+        print('Uploading notes...')
+        uploads = gen_uploads()
+        written_notes = [rel_path for rel_path, _ in uploads] if dry_run else git_helper.write_files(uploads)
+
+    # store each file the notes refer to once, and download it once as well
+    manifest = UploadManifest.load(git_helper, prefix)
+    with timed('fetch uploads'):
+        print('Fetching uploads...')
+        missing_names = sorted(name for name in upload_names if manifest.get(name) is None)
+        written_notes += store_uploads(missing_names, manifest, dry_run)
+
+    # the remote notes left unmatched are deleted, untitled or excluded from pushing
     if overwrite:
+        existing_ids = hedgedoc.get_note_ids(owner=owner) if incremental else set()
+        for change in git_notes.removed():
+            if change.target.id in existing_ids and change.target.id not in listed_notes:
+                continue  # not updated since the last sync
+            deprecated_notes.add(change.target.path)
+            state.notes.pop(change.target.id, None)
+    if not incremental:
+        for note_id in [note_id for note_id in state.notes if note_id not in listed_notes]:
+            del state.notes[note_id]
+        # drop the entries of the files removed without updating the index
+        for rel_path in [rel_path for rel_path in index.entries if rel_path not in git_files.keys() | new_notes]:
+            index.remove(rel_path)
+    deprecated_notes -= {note['path'] for note in state.notes.values()}
+
+    with timed('remove'):
         print('Removing notes remotely...')
-        for rel_path in deprecated_notes:
-            path = git_helper.repo_path / rel_path
-            alias = Note.get_alias(content=path.read_text(encoding='utf-8'))
-            print(f'\t{path.stem} ({alias})')
+        for rel_path in sorted(deprecated_notes):
+            alias = entry['alias'] if (entry := index.entries.get(rel_path)) else Note.get_alias(
+                content=git_helper.read_text(rel_path),
+            )
+            print(f'\t{Path(rel_path).stem} ({alias})')
+            index.remove(rel_path)
+            if plan is not None:
+                plan.removes.append({'path': rel_path, 'base': git_files[rel_path]})
             if not dry_run:
-                path.unlink()
+                git_helper.remove_file(rel_path)
+
+    if plan is not None:
+        plan.aliases = [
+            {'id': str(note_id), 'alias': alias, 'new_alias': new_alias}
+            for note_id, (alias, new_alias) in aliases.items()
+        ]
+        plan.writes.sort(key=lambda write: write['path'])
+        plan.uploads = missing_names
+        plan.watermark = state.watermark.isoformat() if state.watermark else None
+        plan.notes = {note_id: note for note_id, note in state.notes.items() if prev_notes.get(note_id) != note}
+        plan.notes.update((note_id, None) for note_id in prev_notes.keys() - state.notes.keys())
+
+    notes = [*written_notes, *deprecated_notes]
+    for metadata in (index, manifest):
+        if metadata.changed and not dry_run:
+            metadata.save(git_helper)
+            notes.append(metadata.path)
+    return notes, state
+
+
+def sync(comment: str, *, dry_run: bool) -> None:
+    """Sync the notes both ways in a single pass, merging the changes made on either side since the last sync.
+
+    The sync state is the merge base, see note_diff.resolve: a note changed on one side only is synced to the
+    other, while a note changed differently on both sides is reported as a conflict and left as is on both.
+    """
+    git_helper.pull()
+    owner = hedgedoc.get_current_user()
+    state = SyncState.load(str(owner.id))
+    index = NoteIndex.load(git_helper)
+    base_ids = {note['path']: note_id for note_id, note in state.notes.items()}
+
+    # scan both sides once, reading only the files and notes changed since they were read last
+    git_notes = (
+        NoteRecord(rel_path, entry['hash'], entry['id'] or base_ids.get(rel_path, ''), entry['alias'],
+                   tuple(entry['tags']))
+        for rel_path, entry in scan_git_notes(index).items()
+    )
+    rows: dict[str, Row] = {}
+    hedgedoc_notes = (  # the untitled and empty notes are not pushed
+        note for note in gen_hedgedoc_notes(owner, state, rows) if rows[note.id].title and note.hash != EMPTY_HASH
+    )
+
+    def learn_id(rel_path: str, note_id: str) -> None:
+        if (entry := index.entries.get(rel_path)) is not None and entry['id'] != note_id:
+            index.set(rel_path, {**entry, 'id': note_id})
+
+    with timed('diff'):
+        writes: dict[uuid.UUID, str] = {}  # notes to be written to git, to their paths
+        removes: set[str] = set()  # files to be removed from git
+        new_notes: list[Path] = []  # files to be created as notes in Hedgedoc
+        modified_notes: dict[uuid.UUID, Path] = {}  # notes to be updated in Hedgedoc
+        deprecated_ids: list[uuid.UUID] = []  # notes to be deleted in Hedgedoc
+        conflicts: list[str] = []
+        diverged = False  # whether any note is left out of sync, i.e. conflicting or excluded
+        seen_ids: set[str] = set()
+        for change in diff_notes(git_notes, hedgedoc_notes):
+            source, target = change.source, change.target
+            note_id = target.id if target is not None else source.id  # type: ignore
+            seen_ids.add(note_id)
+            base = NoteRecord(prev['path'], prev['hash'], note_id) if (prev := state.notes.get(note_id)) else None
+            resolution = resolve(change, base)
+            if resolution == Resolution.conflict:
+                if source is None:
+                    reason = 'removed from git and edited in Hedgedoc'
+                elif target is None:
+                    reason = 'edited in git and deleted in Hedgedoc'
+                else:
+                    reason = 'edited on both sides'
+                title = rows[note_id].title if target is not None else Path(source.path).stem  # type: ignore
+                conflicts.append(f'{title} ({(source or target).path}): {reason}')  # type: ignore
+                diverged = True
+            elif resolution == Resolution.pushed:
+                if target is None:
+                    removes.add(source.path)  # type: ignore
+                    state.notes.pop(note_id, None)
+                elif set(configs['NOTE__DO_NOT_PUSH']).intersection(target.tags):
+                    diverged = True
+                else:
+                    writes[uuid.UUID(note_id)] = target.path
+                    if source is not None and source.path != target.path:
+                        removes.add(source.path)
+                    note = rows[note_id]
+                    state.update(note_id, target.path, list(target.tags), target.hash, note.updated_at)
+                    index.set(target.path, {
+                        'id': note_id,
+                        'alias': note.alias or Note.get_alias(title=note.title, tags=list(target.tags)),
+                        'title': note.title,
+                        'tags': list(target.tags),
+                        'hash': target.hash,
+                    })
+            elif resolution == Resolution.pulled:
+                if source is None:
+                    deprecated_ids.append(uuid.UUID(note_id))
+                    state.notes.pop(note_id, None)
+                elif set(configs['NOTE__DO_NOT_PULL']).intersection(source.tags):
+                    diverged = True
+                elif target is None:
+                    new_notes.append(Path(source.path))
+                else:
+                    modified_notes[uuid.UUID(note_id)] = Path(source.path)
+                    state.update(note_id, source.path, list(source.tags), source.hash, None)  # updated just now
+                    learn_id(source.path, note_id)
+            elif target is not None:  # unchanged, i.e. on both sides
+                state.update(note_id, target.path, list(target.tags), target.hash, rows[note_id].updated_at)
+                learn_id(target.path, note_id)
+        for note_id in state.notes.keys() - seen_ids:  # gone from both sides
+            del state.notes[note_id]
 
+    # sync to git first, so that nothing changes in Hedgedoc if the remote has moved on since (it is not forced)
+    upload_names: set[str] = set()
+
+    def gen_uploads() -> t.Iterator[tuple[str, str]]:
+        for note_id, content in hedgedoc.get_contents(writes):
+            upload_names.update(hedgedoc.get_upload_names(content))
+            print(f'\t{rows[str(note_id)].title} ({writes[note_id]})')
+            yield writes[note_id], content
+
+    with timed('upload'):
+        print('Uploading notes...')
+        uploads = gen_uploads()
+        written_notes = [rel_path for rel_path, _ in uploads] if dry_run else git_helper.write_files(uploads)
+
+    manifest = UploadManifest.load(git_helper)
+    with timed('fetch uploads'):
+        print('Fetching uploads...')
+        missing_names = sorted(name for name in upload_names if manifest.get(name) is None)
+        written_notes += store_uploads(missing_names, manifest, dry_run)
+
+    with timed('remove'):
+        print('Removing notes remotely...')
+        for rel_path in sorted(removes):
+            print(f'\t{Path(rel_path).stem} ({rel_path})')
+            index.remove(rel_path)
+            if not dry_run:
+                git_helper.remove_file(rel_path)
+
+    notes = [*written_notes, *removes]
+    for metadata in (index, manifest):
+        if metadata.changed and not dry_run:
+            metadata.save(git_helper)
+            notes.append(metadata.path)
+    if notes and not dry_run:
+        try:
+            git_helper.push(comment, notes)
+        except git.GitCommandError:
+            exit_with_error('The remote has changed during the sync, nothing is synced to Hedgedoc; sync again')
+
+    new_notes.sort()
+    deprecated_notes = hedgedoc.get_notes(ids=deprecated_ids) if deprecated_ids else []
+    sync_notes(new_notes, modified_notes, deprecated_notes, overwrite=True, dry_run=dry_run)
+
+    if conflicts:
+        print('Conflicts (left as is on both sides):')
+        for conflict in conflicts:
+            print(f'\t{conflict}')
     if not dry_run:
-        notes = list(str(path) for path in [*map(gen_rel_path, new_notes), *deprecated_notes])
-        git_helper.push(comment, notes, force=True)
+        # the state of a note left out of sync does not match the repository, so the next push has to scan it all
+        state.save(None if diverged else git_helper.head())
+
+
+def store_uploads(names: list[str], manifest: UploadManifest, dry_run: bool) -> list[str]:
+    """Download the uploaded files and store each once, returning the files written."""
+    written_files = []
+    stored_uploads: set[str] = set()
+    for name, data in [(name, b'') for name in names] if dry_run else hedgedoc.get_uploads(names):
+        if data is None:
+            print(f'\t{name} not found or failed, skipped')
+            continue
+        print(f'\t{name}')
+        if dry_run or (rel_path := manifest.add(name, data)) in stored_uploads:
+            continue
+        stored_uploads.add(rel_path)
+        if git_helper.write_file(rel_path, data):
+            written_files.append(rel_path)
+    return written_files
+
+
+def plan(path: Path, comment: str | None, *, overwrite: bool) -> None:
+    """Write the changes a pull, or a push if given a comment, is to make into a plan without making them."""
+    git_helper.pull()
+    sync_plan = SyncPlan(
+        'pull' if comment is None else 'push', str(hedgedoc.get_current_user().id),
+        overwrite=overwrite, comment=comment, commit=git_helper.head(),
+    )
+    if comment is None:
+        pull(overwrite=overwrite, dry_run=True, plan=sync_plan)
+    else:
+        push(comment, overwrite=overwrite, dry_run=True, plan=sync_plan)
+    sync_plan.save(path)
+    changes = [sync_plan.creates, sync_plan.updates, sync_plan.deletes, sync_plan.writes, sync_plan.removes]
+    print(f'Planned {sum(map(len, changes))} changes and {len(sync_plan.aliases)} re-aliases into {path}')
+
+
+def check_aliases(plan: SyncPlan, stale: list[str]) -> list[Note]:
+    """Return the notes to be re-aliased, adding the ones changed since the plan to `stale`."""
+    aliases = {change['id']: change for change in plan.aliases}
+    notes = hedgedoc.get_notes(ids=[uuid.UUID(note_id) for note_id in aliases]) if aliases else []
+    for note in notes:
+        change = aliases.pop(str(note.id))
+        new_alias = Note.get_alias(title=note.title, tags=note.tags)
+        if note.alias != change['alias'] or new_alias != change['new_alias']:
+            stale.append(note.title)
+    stale.extend(f'{change["id"]} (deleted)' for change in aliases.values())
+    return notes
+
+
+def exit_if_stale(stale: list[str]) -> None:
+    if stale:
+        exit_with_error('The plan is stale, re-run --plan: changed since then are ' + ', '.join(stale))
+
+
+def apply(path: Path) -> None:
+    """Make the changes of a plan, checking only the files and notes they touch for changes since it was made."""
+    sync_plan = SyncPlan.load(path)
+    if sync_plan.owner != str(hedgedoc.get_current_user().id):
+        exit_with_error(f'The plan was made for another user: {path}')
+    git_helper.pull()
+    if sync_plan.action == 'pull':
+        apply_pull(sync_plan)
+    else:
+        apply_push(sync_plan)
+
+
+def apply_pull(plan: SyncPlan) -> None:
+    files = git_helper.ls_files()
+    stale = [
+        change['path'] for change in [*plan.creates, *plan.updates] if files.get(change['path']) != change['hash']
+    ]
+    bases = {uuid.UUID(change['id']): change for change in [*plan.updates, *plan.deletes]}
+    checked_ids = set()
+    for note_id, content in hedgedoc.get_contents(bases):
+        checked_ids.add(note_id)
+        if hash_content(content or '') != bases[note_id]['base']:
+            stale.append(bases[note_id]['path'])
+    stale.extend(change['path'] for note_id, change in bases.items() if note_id not in checked_ids)
+    aliased_notes = check_aliases(plan, stale)
+    exit_if_stale(stale)
+
+    deleted_ids = [uuid.UUID(change['id']) for change in plan.deletes]
+    sync_notes(
+        [Path(change['path']) for change in plan.creates],
+        {uuid.UUID(change['id']): Path(change['path']) for change in plan.updates},
+        hedgedoc.get_notes(ids=deleted_ids) if deleted_ids else aliased_notes,
+        overwrite=plan.overwrite, dry_run=False,
+    )
+
+
+def apply_push(plan: SyncPlan) -> None:
+    head = git_helper.head()
+    files = git_helper.ls_files()
+    stale = [
+        change['path'] for change in [*plan.writes, *plan.removes] if files.get(change['path']) != change['base']
+    ]
+    aliased_notes = check_aliases(plan, stale)
+    exit_if_stale(stale)
+
+    # the contents are checked while written, as nothing is committed (or kept on the next pull) if any is stale
+    writes = {uuid.UUID(write['entry']['id']): write for write in plan.writes}
+    written_ids = set()
+
+    def gen_uploads() -> t.Iterator[tuple[str, str]]:
+        for note_id, content in hedgedoc.get_contents(writes):
+            written_ids.add(note_id)
+            if hash_content(content or '') != writes[note_id]['hash']:
+                stale.append(writes[note_id]['path'])
+            elif not stale:
+                print(f'\t{writes[note_id]["entry"]["title"]} ({writes[note_id]["path"]})')
+                yield writes[note_id]['path'], content
+
+    with timed('upload'):
+        print('Uploading notes...')
+        notes = git_helper.write_files(gen_uploads())
+    stale.extend(write['path'] for note_id, write in writes.items() if note_id not in written_ids)
+    exit_if_stale(stale)
+    hedgedoc.refresh_alias(aliased_notes)
+
+    manifest = UploadManifest.load(git_helper)
+    with timed('fetch uploads'):
+        print('Fetching uploads...')
+        missing = [name for name in plan.uploads if manifest.get(name) is None]
+        notes += store_uploads(missing, manifest, dry_run=False)
+
+    index = NoteIndex.load(git_helper)
+    for write in plan.writes:
+        index.set(write['path'], write['entry'])
+    with timed('remove'):
+        print('Removing notes remotely...')
+        for remove in plan.removes:
+            print(f'\t{Path(remove["path"]).stem}')
+            index.remove(remove['path'])
+            git_helper.remove_file(remove['path'])
+            notes.append(remove['path'])
+    for metadata in (index, manifest):
+        if metadata.changed:
+            metadata.save(git_helper)
+            notes.append(metadata.path)
+
+    state = SyncState.load(plan.owner)
+    in_sync = state.commit == plan.commit == head
+    for note_id, note in plan.notes.items():
+        if note is None:
+            state.notes.pop(note_id, None)
+        else:
+            state.notes[note_id] = note
+    state.watermark = datetime.fromisoformat(plan.watermark) if plan.watermark else None
+    message = plan.comment or datetime.now().strftime('Pushed at %Y-%m-%d %H:%M:%S')
+    commit(message, notes, [state] if in_sync else [])
+    if not in_sync:
+        state.save(None)  # the state misses the notes pushed since the plan was made, i.e. a full sync next
+
+
+def export(path: Path, *, dry_run: bool) -> None:
+    """Write the notes into an archive laid out as the repository, streaming them from the database in batches."""
+    with open_archive(path) if not dry_run else contextlib.nullcontext() as archive:
+        owner = hedgedoc.get_current_user()
+        print('Exporting notes...')
+        for note in hedgedoc.iter_notes(owner=owner, with_content=True):
+            tags = Note.get_tags(note.content or '')
+            if not note.title or not note.content or set(configs['NOTE__DO_NOT_PUSH']).intersection(tags):
+                continue
+
+            rel_path = gen_rel_path(tags, note.title)
+            print(f'\t{note.title} ({rel_path})')
+            if archive is not None:
+                archive.add(rel_path, note.content, note.updated_at)
+
+
+def get_revision_content(revision: Row, read_previous: t.Callable[[], str]) -> str:
+    """Return the content of a note at a revision, patching the previous one unless the revision has it all."""
+    if revision.content is not None:
+        return revision.content
+    if revision.patch is None:
+        return revision.last_content or ''
+
+    try:
+        from diff_match_patch import diff_match_patch
+    except ImportError:
+        exit_with_error('Exporting the history requires diff-match-patch, e.g. `pipenv install diff-match-patch`')
+    dmp = diff_match_patch()
+    content, applied = dmp.patch_apply(dmp.patch_fromText(revision.patch), read_previous())
+    if not all(applied):
+        print(f'\t{revision.title} ({revision.created_at}): the revision applies partially')
+    return content
+
+
+def get_revision_author(revision: Row, users: dict[str, User]) -> tuple[str, str]:
+    """Return the name and email of the user who edited a revision last, or else of the owner of the note."""
+    try:
+        # the user of the span updated last
+        user_id = max(json.loads(revision.authorship or '[]'), key=lambda span: span[4])[0]
+    except (ValueError, TypeError, IndexError):
+        user_id = None
+    if (user := users.get(str(user_id)) or users.get(str(revision.owner_id))) is None:
+        return 'Hedgedoc', configs.get('GIT_EMAIL') or f'hedgedoc@{hedgedoc.server.host}'
+    return user.name, user.email or f'{user.id}@{hedgedoc.server.host}'
+
+
+def export_history(*, dry_run: bool) -> None:
+    """Commit the revisions of the notes made since the last export onto GIT_HISTORY_REF, one commit per revision.
+
+    The revisions are streamed in the order they were made, so an interrupted export resumes from the last one.
+    """
+    owner = hedgedoc.get_current_user()
+    users = {str(user.id): user for user in hedgedoc.get_users()}
+    history = HistoryWriter(git_helper, configs['GIT_HISTORY_REF'])
+    print('Exporting revisions...')
+    for revision in hedgedoc.iter_revisions(owner=owner, since=history.watermark):
+        print(f'\t{revision.title} ({revision.created_at:%Y-%m-%d %H:%M:%S})')
+        if dry_run:
+            continue
+
+        note_id = str(revision.note_id)
+        content = get_revision_content(revision, lambda: history.read_note(note_id))
+        meta = Note.parse(content)
+        if set(configs['NOTE__DO_NOT_PUSH']).intersection(meta.tags):
+            history.skip(note_id, content)  # the next revision is patched onto it all the same
+            continue
+        history.commit(
+            note_id, gen_rel_path(list(meta.tags), meta.title), content,
+            message=meta.title, author=get_revision_author(revision, users),
+            revision=(revision.created_at, str(revision.id)),
+        )
+    if not dry_run:
+        history.push()
+
+
+def watch(*, overwrite: bool, dry_run: bool, interval: float, debounce: float) -> None:
+    """Keep pushing the notes whenever they change, reusing the database session, HTTP client and git mirror."""
+    owner = hedgedoc.get_current_user()
+    hedgedoc.session.expunge(owner)  # so that it outlives the session removed after each cycle
+    token = None
+    try:
+        while True:
+            try:
+                if (latest := hedgedoc.get_change_token(owner)) == token:  # idle, i.e. a single cheap query
+                    hedgedoc.wait_for_changes(interval)
+                    continue
+
+                # wait for a burst of edits to settle, so that it is committed at once
+                while token is not None:
+                    time.sleep(debounce)
+                    if (settled := hedgedoc.get_change_token(owner)) == latest:
+                        break
+                    latest = settled
+
+                if is_initialized(git_helper):
+                    git_helper.fetch()  # pick up the commits pushed by others since the last cycle
+                with timed('push'):
+                    message = datetime.now().strftime('Pushed at %Y-%m-%d %H:%M:%S')
+                    push(message, overwrite=overwrite, dry_run=dry_run)
+                hedgedoc.flush_history()
+                token = latest
+            except Exception as e:  # e.g. a dropped connection, retried rather than ending the watch
+                print(f'Failed to push, retrying in {interval:g} seconds: {e!r}', file=sys.stderr)
+                time.sleep(interval)
+            finally:
+                hedgedoc.session.remove()  # rather than idling in a transaction until the next cycle
+    except KeyboardInterrupt:
+        print('Stopped watching')
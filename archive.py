@@ -0,0 +1,101 @@
+import abc
+import io
+import tarfile
+import typing as t
+import zipfile
+from datetime import datetime
+from pathlib import Path
+
+from utils import count, exit_with_error
+
+# the suffixes of the supported archives and their tar compression, see open_archive
+TAR_SUFFIXES = {'.tar.zst': 'zst', '.tar.gz': 'gz', '.tgz': 'gz', '.tar': ''}
+
+
+class Archive(abc.ABC):
+    """A streaming archive of notes, written into a temporary file moved into place once complete."""
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.tmp_path = path.with_name(f'{path.name}.tmp')
+        self.file = self.tmp_path.open('wb')
+
+    @abc.abstractmethod
+    def add(self, rel_path: str, content: str, mtime: datetime) -> None:
+        """Write a note into the archive."""
+
+    def finish(self) -> None:
+        """Write the end of the archive."""
+
+    def __enter__(self) -> t.Self:
+        return self
+
+    def __exit__(self, exc_type, *args) -> None:
+        self.finish()
+        self.file.close()
+        if exc_type is None:
+            self.tmp_path.replace(self.path)
+        else:  # leave no partial archive behind
+            self.tmp_path.unlink(missing_ok=True)
+
+
+class ZipArchive(Archive):
+    def __init__(self, path: Path) -> None:
+        super().__init__(path)
+        self.zip = zipfile.ZipFile(self.file, 'w', zipfile.ZIP_DEFLATED)
+
+    def add(self, rel_path: str, content: str, mtime: datetime) -> None:
+        data = content.encode('utf-8')
+        info = zipfile.ZipInfo(rel_path, date_time=mtime.timetuple()[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED
+        self.zip.writestr(info, data)
+        count('files written')
+        count('bytes written', len(data))
+
+    def finish(self) -> None:
+        self.zip.close()
+
+
+class TarArchive(Archive):
+    def __init__(self, path: Path, compression: str) -> None:
+        super().__init__(path)
+        self.stream: t.BinaryIO = self.file
+        if compression == 'zst':
+            try:
+                import zstandard
+            except ImportError:
+                self.file.close()
+                self.tmp_path.unlink()
+                exit_with_error('Exporting to .tar.zst requires zstandard, e.g. `pipenv install zstandard`')
+            self.stream = zstandard.ZstdCompressor().stream_writer(self.file, closefd=False)
+            compression = ''
+        self.tar = tarfile.open(fileobj=self.stream, mode=f'w|{compression}')  # a stream, i.e. no seeking back
+
+    def add(self, rel_path: str, content: str, mtime: datetime) -> None:
+        data = content.encode('utf-8')
+        info = tarfile.TarInfo(rel_path)
+        info.size = len(data)
+        info.mtime = int(mtime.timestamp())
+        info.mode = 0o644
+        self.tar.addfile(info, io.BytesIO(data))
+        count('files written')
+        count('bytes written', len(data))
+
+    def finish(self) -> None:
+        self.tar.close()
+        if self.stream is not self.file:
+            self.stream.close()  # flush the end of the zstd frame
+
+
+def is_supported(path: Path) -> bool:
+    return path.name.endswith(('.zip', *TAR_SUFFIXES))
+
+
+def open_archive(path: Path) -> Archive:
+    """Create an archive of the format its file name ends with, i.e. .zip, .tar.zst, .tar.gz, .tgz or .tar."""
+    if path.name.endswith('.zip'):
+        return ZipArchive(path)
+    for suffix, compression in TAR_SUFFIXES.items():
+        if path.name.endswith(suffix):
+            return TarArchive(path, compression)
+    exit_with_error(f'Unsupported archive: {path.name}')
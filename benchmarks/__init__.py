@@ -0,0 +1,4 @@
+"""Benchmarks of hedge2git against local stand-ins of the database, the git remote and the Hedgedoc server.
+
+Run `python -m benchmarks --help` from the repository root.
+"""
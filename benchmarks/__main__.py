@@ -0,0 +1,54 @@
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+
+from .runner import run
+
+
+@click.command()
+@click.option(
+    '--sizes', 'sizes', metavar='N,N,...',
+    default='1000,10000,100000', show_default=True,
+    help='The numbers of notes of the synthetic corpora.',
+)
+@click.option(
+    '--git-backend', 'git_backends',
+    type=click.Choice(['worktree', 'fast-import']), multiple=True, default=['worktree'], show_default=True,
+    help='The git backends to benchmark, see GIT_BACKEND.',
+)
+@click.option(
+    '--output', 'output', metavar='FILE',
+    type=click.Path(dir_okay=False, writable=True), default=None,
+    help='Write the measurements to a JSON file as well.',
+)
+def benchmark(sizes: str, git_backends: list[str], output: str | None):
+    """
+    Benchmark pull, push and refresh_alias offline, against a local database, git remote and Hedgedoc stub.
+    """
+    results = []
+    print(
+        f'{"notes":>7} {"backend":<12} {"phase":<26} {"seconds":>9} '
+        f'{"cum. peak RSS":>14} {"queries":>8}  requests'
+    )
+    for size in map(int, sizes.split(',')):
+        for git_backend in git_backends:
+            # a fresh process per run, so that the singletons and the peak RSS start over
+            with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                measurements = executor.submit(run, size, git_backend).result()
+            for m in measurements:
+                requests = ', '.join(f'{endpoint}: {count}' for endpoint, count in sorted(m['requests'].items()))
+                print(
+                    f'{m["size"]:>7} {m["git_backend"]:<12} {m["phase"]:<26} {m["seconds"]:>9.3f} '
+                    f'{m["cumulative_peak_rss_mib"]:>10.1f} MiB {m["queries"]:>8}  {requests}'
+                )
+            results += measurements
+
+    if output is not None:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    benchmark()
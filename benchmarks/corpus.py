@@ -0,0 +1,57 @@
+import random
+import typing as t
+import uuid
+from datetime import datetime, timedelta
+
+WORDS = (
+    'alpha beta gamma delta epsilon zeta theta kappa lambda sigma omega apple banana cherry grape lemon mango '
+    'orange peach pear plum river mountain forest ocean desert island valley canyon glacier meadow python rust '
+    'golang kotlin swift haskell scala docker kubernetes linux kernel network storage cache index query schema '
+    'backup deploy release review design meeting notes draft todo idea journal recipe travel budget health '
+    'reading'
+).split()
+
+# the number of tags of a note, i.e. the depth of its path, and how likely it is
+TAG_DEPTHS = (0, 1, 2, 3, 4)
+TAG_DEPTH_WEIGHTS = (10, 40, 30, 15, 5)
+
+
+def gen_content(rng: random.Random, title: str, tags: list[str]) -> str:
+    """Return a note in one of the styles Hedgedoc users write their metadata in."""
+    body = [f'{title}\n{"=" * len(title)}\n']
+    for _ in range(rng.randint(1, 12)):
+        body.append(' '.join(rng.choices(WORDS, k=rng.randint(20, 80))) + '\n')
+        if rng.random() < 0.2:
+            body.append('```python\n' + '\n'.join(f'x{i} = {i}' for i in range(rng.randint(1, 10))) + '\n```\n')
+
+    style = rng.random()
+    if not tags:
+        meta = ''
+    elif style < 0.5:
+        meta = f'---\ntitle: {title}\ntags: {", ".join(tags)}\ndescription: {rng.choice(WORDS)}\n---\n'
+    elif style < 0.7:
+        meta = '---\ntags:\n' + ''.join(f'  - {tag}\n' for tag in tags) + 'lang: en\n---\n'
+    else:
+        meta = '###### tags: ' + ', '.join(f'`{tag}`' for tag in tags) + '\n'
+    return meta + '\n'.join(body)
+
+
+def gen_notes(count: int, owner_id: uuid.UUID, seed: int = 0) -> t.Iterator[dict[str, t.Any]]:
+    """Generate the rows of `count` notes with unique titles, as the Notes table stores them."""
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1).astimezone()
+    for i in range(count):
+        title = f'{rng.choice(WORDS).title()} {rng.choice(WORDS)} {i}'
+        depth = rng.choices(TAG_DEPTHS, TAG_DEPTH_WEIGHTS)[0]
+        tags = rng.sample(WORDS, depth)
+        updated_at = start + timedelta(minutes=i)
+        yield {
+            'id': uuid.UUID(int=rng.getrandbits(128), version=4),
+            'short_id': f'{i:x}-{rng.getrandbits(32):08x}',
+            'alias': None,
+            '_title': title,
+            'content': gen_content(rng, title, tags),
+            'created_at': updated_at,
+            'updated_at': updated_at,
+            'owner_id': owner_id,
+        }
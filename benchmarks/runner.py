@@ -0,0 +1,155 @@
+import contextlib
+import os
+import resource
+import subprocess
+import tempfile
+import time
+import typing as t
+import uuid
+from datetime import datetime
+from itertools import batched
+from pathlib import Path
+
+from sqlalchemy import create_engine, delete, event, insert, select, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from configs import configs
+
+from .corpus import gen_notes
+from .stubs import HedgedocStub
+
+OWNER_ID = uuid.UUID('b0b0b0b0-cafe-4bad-beef-b0b0b0b0b0b0')
+OWNER_EMAIL = 'bench@example.com'
+
+queries = 0
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_query(*args) -> None:
+    global queries
+    queries += 1
+
+
+def get_peak_rss() -> float:
+    """Return the peak resident set size of the process so far in MiB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def setup(workdir: Path, server: str, size: int, git_backend: str) -> None:
+    """Point hedge2git at a seeded local database, a local bare remote and the stub server."""
+    remote = workdir / 'remote.git'
+    subprocess.run(['git', 'init', '--quiet', '--bare', str(remote)], check=True)
+    configs.update({
+        'DB_URL': f'sqlite:///{workdir / "hedgedoc.sqlite"}',
+        'HEDGEDOC_SERVER': server,
+        'HEDGEDOC_USER': OWNER_EMAIL,
+        'HEDGEDOC_PASS': 'bench',
+        'GIT_REPO': str(remote),
+        'GIT_REF': 'main',
+        'GIT_USER': 'bench',
+        'GIT_EMAIL': OWNER_EMAIL,
+        'GIT_BACKEND': git_backend,
+        'CACHE_DIR': workdir / 'cache',
+        'LOCAL_REPO': workdir / 'cache' / ('repo.git' if git_backend == 'fast-import' else 'repo'),
+        'NOTE__DO_NOT_PULL': [''],
+        'NOTE__DO_NOT_PUSH': [''],
+    })
+
+    from hedgedoc.models import Base, Note, User
+    engine = create_engine(configs['DB_URL'])
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:  # an ORM insert, as the rows are keyed by the attribute names
+        session.execute(insert(User).values(id=OWNER_ID, email=OWNER_EMAIL))
+        for chunk in batched(gen_notes(size, OWNER_ID), 1000):
+            session.execute(insert(Note), list(chunk))
+        session.commit()
+    engine.dispose()
+
+
+def edit_notes(fraction: float) -> None:
+    """Touch a fraction of the notes, as if they had been edited in Hedgedoc."""
+    from hedgedoc import hedgedoc
+    from hedgedoc.models import Note
+    note_ids = hedgedoc.session.scalars(select(Note.id)).all()[::round(1 / fraction)]
+    for chunk in batched(note_ids, configs['DB_BATCH_SIZE']):
+        hedgedoc.session.execute(update(Note).where(Note.id.in_(chunk)).values(
+            content=Note.content + f'\nedited at {time.time()}\n', updated_at=datetime.now().astimezone(),
+        ))
+    hedgedoc.session.commit()
+
+
+def delete_notes(fraction: float) -> None:
+    """Delete a fraction of the notes from the database, so that the next pull creates them back."""
+    from hedgedoc import hedgedoc
+    from hedgedoc.models import Note
+    note_ids = hedgedoc.session.scalars(select(Note.id)).all()[::round(1 / fraction)]
+    for chunk in batched(note_ids, configs['DB_BATCH_SIZE']):
+        hedgedoc.session.execute(delete(Note).where(Note.id.in_(chunk)))
+    hedgedoc.session.commit()
+
+
+def forget_state() -> None:
+    """Drop the sync state, so that the next push diffs every note."""
+    (configs['CACHE_DIR'] / 'state.json').unlink(missing_ok=True)
+
+
+def unalias_notes() -> None:
+    from hedgedoc import hedgedoc
+    from hedgedoc.models import Note
+    hedgedoc.session.execute(update(Note).values(alias=None))
+    hedgedoc.session.commit()
+
+
+def run(size: int, git_backend: str) -> list[dict[str, t.Any]]:
+    """Run each phase on a corpus of `size` notes and return their measurements."""
+    import _helpers
+    from hedgedoc import hedgedoc
+
+    def push() -> None:
+        _helpers.push('Benchmark', overwrite=True, dry_run=False)
+
+    def pull() -> None:
+        _helpers.pull(overwrite=False, dry_run=False)
+
+    def refresh_alias() -> None:
+        hedgedoc.refresh_alias()
+
+    # (phase, preparation, operation)
+    phases: list[tuple[str, t.Callable[[], None] | None, t.Callable[[], None]]] = [
+        ('push (initial)', None, push),
+        ('push (unchanged)', None, push),
+        ('push (1% edited)', lambda: edit_notes(0.01), push),
+        ('push (without state)', forget_state, push),
+        ('refresh_alias (unchanged)', None, refresh_alias),
+        ('refresh_alias (all)', unalias_notes, refresh_alias),
+        ('pull (1% deleted)', lambda: delete_notes(0.01), pull),
+    ]
+
+    global queries
+    results = []
+    with (
+        tempfile.TemporaryDirectory(prefix='hedge2git-bench-') as workdir,
+        HedgedocStub() as stub,
+        open(os.devnull, 'w') as devnull,
+    ):
+        setup(Path(workdir), stub.url, size, git_backend)
+        for phase, prepare, operation in phases:
+            if prepare is not None:
+                prepare()
+            queries = 0
+            stub.requests.clear()
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(devnull):  # the notes listed are of no interest here
+                operation()
+                hedgedoc.flush_history()
+            results.append({
+                'size': size,
+                'git_backend': git_backend,
+                'phase': phase,
+                'seconds': time.perf_counter() - start,
+                'cumulative_peak_rss_mib': get_peak_rss(),  # of the run so far, as the phases share the process
+                'queries': queries,
+                'requests': dict(stub.requests),
+            })
+    return results
@@ -0,0 +1,63 @@
+import json
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class HedgedocStub(ThreadingHTTPServer):
+    """A stand-in for the Hedgedoc endpoints hedge2git calls, counting the requests per endpoint."""
+
+    def __init__(self) -> None:
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.requests: Counter[str] = Counter()
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/'
+
+    def __enter__(self) -> 'HedgedocStub':
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.shutdown()
+        self.server_close()
+
+    def count(self, endpoint: str) -> None:
+        with self.lock:
+            self.requests[endpoint] += 1
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    server: HedgedocStub
+    protocol_version = 'HTTP/1.1'  # keep-alive, as the Hedgedoc server does
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def reply(self, status: int, body: bytes = b'', headers: dict[str, str] = {}) -> None:
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        path = self.path.strip('/')
+        if path in ('me', 'history'):
+            self.server.count(f'GET {path}')
+            body = {'status': 'ok'} if path == 'me' else {'history': []}
+            self.reply(200, json.dumps(body).encode(), {'Content-Type': 'application/json'})
+        else:  # a short id, redirected to the note
+            self.server.count('GET short id')
+            self.reply(302, headers={'Location': f'{self.server.url}{path}'})
+
+    def do_POST(self) -> None:
+        path = self.path.strip('/')
+        self.server.count(f'POST {path.split("/")[0]}')
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.reply(200)
@@ -1,21 +1,33 @@
-import shutil
 from pathlib import Path
 
 from dotenv import dotenv_values
 
 configs: dict[str, any] = dotenv_values()  # type: ignore
 
+configs['HEDGEDOC_SERVER'] = configs.get('HEDGEDOC_SERVER') or ''
 if not configs['HEDGEDOC_SERVER'].endswith('/'):
     configs['HEDGEDOC_SERVER'] += '/'
 
-configs['LOCAL_REPO'] = sync_path = Path('/tmp/hedge2git')  # noqa: S108
-if sync_path.exists():
-    bak_path = sync_path.with_suffix('.bak')
-    if bak_path.exists():
-        shutil.rmtree(bak_path)
+# persistent working directory reused across runs
+configs['CACHE_DIR'] = cache_path = Path(
+    configs.get('CACHE_DIR') or Path.home() / '.cache' / 'hedge2git'
+).expanduser()
+configs['GIT_BACKEND'] = configs.get('GIT_BACKEND') or 'worktree'  # or 'fast-import'
+configs['GIT_HISTORY_REF'] = configs.get('GIT_HISTORY_REF') or 'history'
+configs['LOCAL_REPO'] = Path(
+    configs.get('LOCAL_REPO') or cache_path / ('repo.git' if configs['GIT_BACKEND'] == 'fast-import' else 'repo')
+).expanduser()
 
-    shutil.move(sync_path, bak_path)
-    sync_path.mkdir()
+configs['DB_BATCH_SIZE'] = int(configs.get('DB_BATCH_SIZE') or 1000)
+configs['DB_NOTIFY_CHANNEL'] = configs.get('DB_NOTIFY_CHANNEL') or None
+configs['HTTP_CONCURRENCY'] = int(configs.get('HTTP_CONCURRENCY') or 8)
+configs['HTTP_RETRIES'] = int(configs.get('HTTP_RETRIES') or 5)
+configs['HTTP_UPLOAD_TIMEOUT'] = float(configs.get('HTTP_UPLOAD_TIMEOUT') or 60)
+configs['HTTP2'] = (configs.get('HTTP2') or '').lower() in ('1', 'true', 'yes')
+configs['CREATE_NOTES_VIA'] = configs.get('CREATE_NOTES_VIA') or 'database'  # or 'api'
+configs['IO_CONCURRENCY'] = int(configs.get('IO_CONCURRENCY') or 8)
+configs['USER_CONCURRENCY'] = int(configs.get('USER_CONCURRENCY') or 4)
+configs['DIFF_SPILL_THRESHOLD'] = int(configs.get('DIFF_SPILL_THRESHOLD') or 50000)
 
-configs['NOTE__DO_NOT_PULL'] = configs['NOTE__DO_NOT_PULL'].split(',')
-configs['NOTE__DO_NOT_PUSH'] = configs['NOTE__DO_NOT_PUSH'].split(',')
+configs['NOTE__DO_NOT_PULL'] = (configs.get('NOTE__DO_NOT_PULL') or '').split(',')
+configs['NOTE__DO_NOT_PUSH'] = (configs.get('NOTE__DO_NOT_PUSH') or '').split(',')
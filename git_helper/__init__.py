@@ -1 +1,4 @@
 from .core import git_helper
+from .history import HistoryWriter
+from .index import INDEX_PATH, IndexEntry, NoteIndex
+from .uploads import MANIFEST_PATH, UploadManifest
@@ -1,9 +1,13 @@
 import pathlib
+import shutil
+import threading
+import typing as t
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 
 import git
 
 from configs import configs
-from utils import exit_with_error
+from utils import Lazy, count, exit_with_error, lock_dir, submit, timed
 
 
 class GitHelper:
@@ -13,27 +17,152 @@ class GitHelper:
         self.ref: str = configs['GIT_REF']
         self.user_name: str = configs['GIT_USER']
         self.user_email: str = configs['GIT_EMAIL']
+        # GitPython talks to a single `git cat-file` process per repository, which the threads take turns on
+        self.lock = threading.RLock()
 
-        self.git_repo = git.Repo.init(self.repo_path)
-        self.git_remote = self.git_repo.create_remote('origin', self.repo)
+        self.git_repo = self.open_repo()
+        self.git_remote = self.get_remote()
+        self.fetch()
+
+    def open_repo(self) -> git.Repo:
+        """Reuse the local mirror if it is healthy, otherwise initialize a new one."""
+        if not (self.repo_path / '.git').exists():
+            return self.init_repo()
+
+        # a stale lock means a previous run was killed in the middle of an index update, as no other run is live
+        (self.repo_path / '.git' / 'index.lock').unlink(missing_ok=True)
+        try:
+            repo = git.Repo(self.repo_path)
+            repo.git.status('--porcelain')  # reads the index
+            if repo.head.is_valid():
+                repo.git.cat_file('-e', 'HEAD^{tree}')
+        except (git.InvalidGitRepositoryError, git.GitCommandError, ValueError):
+            print(f'Recreating the corrupted local repository: {self.repo_path}')
+            return self.recreate_repo()
+        return repo
+
+    def init_repo(self) -> git.Repo:
+        self.repo_path.mkdir(parents=True, exist_ok=True)
+        return git.Repo.init(self.repo_path, initial_branch=self.ref)  # git init -b GIT_REF
+
+    def recreate_repo(self) -> git.Repo:
+        """Move the local mirror aside and initialize a new one."""
+        bak_path = self.repo_path.with_suffix('.bak')
+        if bak_path.exists():
+            shutil.rmtree(bak_path)
+        if self.repo_path.exists():
+            shutil.move(self.repo_path, bak_path)
+
+        self.git_repo = self.init_repo()
+        self.git_remote = self.get_remote()
+        return self.git_repo
+
+    def get_remote(self) -> git.Remote:
+        if 'origin' not in self.git_repo.remotes:
+            return self.git_repo.create_remote('origin', self.repo)  # git remote add origin GIT_REPO
+
+        remote = self.git_repo.remote('origin')
+        if remote.url != self.repo:
+            remote.set_url(self.repo)  # git remote set-url origin GIT_REPO
+        return remote
+
+    @timed('git fetch')
+    def fetch(self) -> None:
         try:
-            self.git_remote.fetch()  # git fetch origin
+            self.git_remote.fetch()  # git fetch origin (incremental once the mirror exists)
         except git.GitCommandError:
             exit_with_error(f'Invalid git repository: {self.repo}')
 
+    @timed('git pull')
     def pull(self):
-        """Run `git pull origin GIT_REF`"""
+        """Reset the local mirror to `origin/GIT_REF`, dropping leftovers of previous runs."""
         if self.ref in [r.name.split('/')[-1] for r in self.git_remote.refs]:
-            self.git_remote.pull(self.ref)  # git pull origin GIT_REF
+            # git checkout -f -B GIT_REF origin/GIT_REF
+            self.git_repo.git.checkout('-f', '-B', self.ref, f'origin/{self.ref}')
+            self.git_repo.git.clean('-fdq')  # git clean -fdq
+
+    def head(self) -> str | None:
+        """Return the commit hash of HEAD, or None for an empty repository."""
+        with self.lock:
+            return self.git_repo.head.commit.hexsha if self.git_repo.head.is_valid() else None
 
+    @timed('git ls-files')
+    def ls_files(self) -> dict[str, str]:
+        """Return the blob hash of each file committed to HEAD, keyed by its relative path."""
+        if not self.git_repo.head.is_valid():
+            return {}
+
+        files = {}
+        for entry in self.git_repo.git.ls_tree('-r', '-z', 'HEAD').split('\0'):  # git ls-tree -r -z HEAD
+            if not entry:
+                continue
+            info, _, path = entry.partition('\t')
+            _, obj_type, obj_hash = info.split()
+            if obj_type == 'blob':
+                files[path] = obj_hash
+        return files
+
+    def read_bytes(self, rel_path: str) -> bytes:
+        count('files read')
+        return (self.repo_path / rel_path).read_bytes()
+
+    def read_text(self, rel_path: str) -> str:
+        return self.read_bytes(rel_path).decode('utf-8')
+
+    def write_file(self, rel_path: str, content: str | bytes) -> bool:
+        """Write a file into the working tree unless it has the same content, and return whether written."""
+        path = self.repo_path / rel_path
+        data = content.encode('utf-8') if isinstance(content, str) else content
+        try:
+            if path.stat().st_size == len(data) and path.read_bytes() == data:
+                return False
+        except FileNotFoundError:
+            path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+        count('files written')
+        count('bytes written', len(data))
+        return True
+
+    def write_files(self, files: t.Iterable[tuple[str, str]]) -> list[str]:
+        """Write (relative path, content) pairs concurrently as they come, and return the paths written."""
+        concurrency = configs['IO_CONCURRENCY']
+        written = []
+        with ThreadPoolExecutor(concurrency) as executor:
+            pending: dict[Future, str] = {}
+            for rel_path, content in files:
+                pending[submit(executor, self.write_file, rel_path, content)] = rel_path
+                if len(pending) < 4 * concurrency:  # bound the contents held in memory
+                    continue
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                written += [pending.pop(future) for future in done if future.result()]
+            done, _ = wait(pending)
+            written += [pending[future] for future in done if future.result()]
+        return sorted(written)
+
+    def remove_file(self, rel_path: str) -> None:
+        count('files removed')
+        (self.repo_path / rel_path).unlink(missing_ok=True)
+
+    @timed('git push')
     def push(self, comment: str, notes: list[str], *, force: bool = False) -> None:
+        """Commit the given files written or removed, and push the commit to `origin/GIT_REF`."""
         author = git.Actor(self.user_name, self.user_email)
-        self.git_repo.index.add(notes)  # git add NOTES
+        if added := [note for note in notes if (self.repo_path / note).exists()]:
+            self.git_repo.index.add(added)  # git add NOTES
+        if removed := [note for note in notes if not (self.repo_path / note).exists()]:
+            self.git_repo.index.remove(removed)  # git rm --cached NOTES
         self.git_repo.index.commit(comment, author=author, committer=author)  # git commit -m COMMENT
-        # TODO: reuse local repo
-        if self.git_repo.refs[0].name == 'master':
-            self.git_repo.heads.master.rename(self.ref)  # git branch -m master GIT_REF
+        if self.git_repo.active_branch.name != self.ref:
+            self.git_repo.active_branch.rename(self.ref, force=True)  # git branch -M GIT_REF
         self.git_remote.push(self.ref, force=force).raise_if_error()  # git push origin GIT_REF
 
 
-git_helper = GitHelper()
+def create_git_helper() -> GitHelper:
+    lock_dir(configs['CACHE_DIR'])  # before clearing the stale git locks, see GitHelper.open_repo
+    if configs['GIT_BACKEND'] == 'fast-import':
+        from .fast_import import FastImportGitHelper
+        return FastImportGitHelper()
+    return GitHelper()
+
+
+git_helper: GitHelper = Lazy(create_git_helper, 'git_helper')  # type: ignore
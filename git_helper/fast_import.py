@@ -0,0 +1,145 @@
+import subprocess
+import time
+
+import git
+
+from utils import count, hash_content, timed
+
+from .core import GitHelper
+
+
+def quote_path(path: str) -> str:
+    """Quote a path for fast-import if it would be ambiguous otherwise."""
+    if not path.startswith('"') and '\n' not in path:
+        return path
+    return '"' + path.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+
+
+class FastImportGitHelper(GitHelper):
+    """A bare local mirror committed to with `git fast-import`, which never materializes a working tree.
+
+    Written files are streamed to fast-import as blobs right away; `push` then writes a single commit on top of
+    HEAD referencing them, so only the changed files ever touch the disk.
+    """
+
+    def __init__(self):
+        self.files: dict[str, str] | None = None  # cache of ls_files
+        self.blobs: set[str] | None = None  # the blob hashes in HEAD
+        self.marks: dict[str, str] = {}  # the blob (a mark or a hash) of each file written by its relative path
+        self.next_mark = 1
+        self.removed: set[str] = set()
+        self.fast_import: subprocess.Popen | None = None
+        super().__init__()
+
+    def open_repo(self) -> git.Repo:
+        if not (self.repo_path / 'HEAD').exists():
+            return self.init_repo()
+
+        try:
+            repo = git.Repo(self.repo_path)
+            if repo.head.is_valid():
+                repo.git.cat_file('-e', 'HEAD^{tree}')
+        except (git.InvalidGitRepositoryError, git.GitCommandError, ValueError):
+            print(f'Recreating the corrupted local repository: {self.repo_path}')
+            return self.recreate_repo()
+        return repo
+
+    def init_repo(self) -> git.Repo:
+        self.repo_path.mkdir(parents=True, exist_ok=True)
+        return git.Repo.init(self.repo_path, bare=True, initial_branch=self.ref)  # git init --bare -b GIT_REF
+
+    @timed('git pull')
+    def pull(self):
+        """Point GIT_REF at `origin/GIT_REF`, dropping the files written but not pushed."""
+        if self.ref in [r.name.split('/')[-1] for r in self.git_remote.refs]:
+            # git update-ref refs/heads/GIT_REF origin/GIT_REF
+            self.git_repo.git.update_ref(f'refs/heads/{self.ref}', f'refs/remotes/origin/{self.ref}')
+        self.reset()
+
+    def reset(self) -> None:
+        self.files = self.blobs = None
+        self.marks.clear()
+        self.removed.clear()
+
+    def ls_files(self) -> dict[str, str]:
+        with self.lock:
+            if self.files is None:
+                self.files = super().ls_files()
+        return self.files
+
+    def read_bytes(self, rel_path: str) -> bytes:
+        digest = self.ls_files().get(rel_path)
+        if digest is None:
+            raise FileNotFoundError(rel_path)
+        count('files read')
+        with self.lock:
+            return self.git_repo.odb.stream(bytes.fromhex(digest)).read()
+
+    def send(self, data: bytes) -> None:
+        if self.fast_import is None:
+            self.fast_import = subprocess.Popen(
+                ['git', 'fast-import', '--quiet'], cwd=self.repo_path, stdin=subprocess.PIPE,
+            )
+        self.fast_import.stdin.write(data)
+
+    def write_file(self, rel_path: str, content: str | bytes) -> bool:
+        """Stream a file to fast-import unless HEAD has the same content already, and return whether written."""
+        digest = hash_content(content)
+        with self.lock:  # the users synced concurrently share the stream
+            self.removed.discard(rel_path)
+            if self.ls_files().get(rel_path) == digest:
+                self.marks.pop(rel_path, None)
+                return False
+
+            if self.blobs is None:
+                self.blobs = set(self.ls_files().values())
+            if digest in self.blobs:  # e.g. a note moved without changes, committed without sending its content
+                self.marks[rel_path] = digest
+                count('blobs reused')
+                return True
+
+            data = content.encode('utf-8') if isinstance(content, str) else content
+            self.send(b'blob\nmark :%d\ndata %d\n%b\n' % (self.next_mark, len(data), data))
+            count('files written')
+            count('bytes written', len(data))
+            self.marks[rel_path] = f':{self.next_mark}'
+            self.next_mark += 1
+            return True
+
+    def write_files(self, files):
+        # fast-import reads a single stream, so there is nothing to gain from threads
+        return sorted(rel_path for rel_path, content in files if self.write_file(rel_path, content))
+
+    def remove_file(self, rel_path: str) -> None:
+        count('files removed')
+        with self.lock:
+            self.marks.pop(rel_path, None)
+            self.removed.add(rel_path)
+
+    @timed('git push')
+    def push(self, comment: str, notes: list[str], *, force: bool = False) -> None:
+        files = self.ls_files()
+        changes = [
+            f'M 100644 {self.marks[note]} {quote_path(note)}' if note in self.marks else f'D {quote_path(note)}'
+            for note in sorted(set(notes))
+            if note in self.marks or (note in self.removed and note in files)
+        ]
+        if changes:
+            message = comment.encode('utf-8')
+            signature = f'{self.user_name} <{self.user_email}> {int(time.time())} +0000'
+            head = self.head()
+            self.send(b''.join([
+                f'commit refs/heads/{self.ref}\n'.encode('utf-8'),
+                f'author {signature}\ncommitter {signature}\n'.encode('utf-8'),
+                b'data %d\n%b\n' % (len(message), message),
+                f'from {head}\n'.encode('utf-8') if head else b'',
+                *(f'{change}\n'.encode('utf-8') for change in changes),
+                b'\n',
+            ]))
+        if self.fast_import is not None:
+            self.fast_import.stdin.close()
+            if self.fast_import.wait():
+                raise git.GitCommandError('git fast-import', self.fast_import.returncode)
+            self.fast_import = None
+        self.reset()
+        self.git_remote.push(self.ref, force=force).raise_if_error()  # git push origin GIT_REF
@@ -0,0 +1,194 @@
+import json
+import re
+import subprocess
+import typing as t
+from datetime import datetime
+
+import git
+
+from configs import configs
+from utils import count, exit_with_error, timed
+
+from .fast_import import quote_path
+
+if t.TYPE_CHECKING:
+    from .core import GitHelper
+
+REVISION_TRAILER = 'Hedgedoc-Revision'  # the time and id of the revision a commit is made of, i.e. the watermark
+NOTE_TRAILER = 'Hedgedoc-Note'
+
+
+def sanitize_ident(value: str) -> str:
+    """Drop the characters a git ident cannot hold."""
+    return re.sub(r'[<>\n]', '', value).strip()
+
+
+class HistoryWriter:
+    """Commits the revisions of the notes onto a ref of its own with `git fast-import`, one commit per revision.
+
+    The revision of the last commit is the watermark the next export resumes from. The path of each note in the
+    tip is cached in CACHE_DIR/history.json, and recovered from the log whenever the cache does not match the tip.
+    So is the content of each note whose last revision is skipped (see skip), for the next one to be patched onto.
+    """
+
+    def __init__(self, git_helper: 'GitHelper', ref: str) -> None:
+        self.git_helper = git_helper
+        self.ref = ref
+        self.cache_path = configs['CACHE_DIR'] / 'history.json'
+        self.tip = self.get_tip()
+        self.watermark = self.get_watermark()
+        self.hidden: dict[str, str] = {}  # the content of each note whose last revision up to the tip is skipped
+        self.paths = self.load_paths()  # the path of each note in the tip, keyed by Note.id
+        self.skipped: dict[str, str] = {}  # the same as `hidden` for the revisions since the last commit
+        self.blobs: dict[str, str] = {}  # the blob (a mark or a hash) of each path written or read so far
+        self.next_mark = 1
+        self.pending = 0  # the commits written since the last checkpoint
+        self.fast_import: subprocess.Popen | None = None
+
+    def git(self, *args: str) -> str:
+        with self.git_helper.lock:
+            return self.git_helper.git_repo.git.execute(['git', *args])  # type: ignore
+
+    def get_tip(self) -> str | None:
+        """Return the local ref, or the remote one if the local mirror has never exported the history."""
+        for ref in (f'refs/heads/{self.ref}', f'refs/remotes/origin/{self.ref}'):
+            try:
+                return self.git('rev-parse', '--verify', '--quiet', ref)
+            except git.GitCommandError:
+                continue
+        return None
+
+    def get_watermark(self) -> tuple[datetime, str] | None:
+        if self.tip is None:
+            return None
+        message = self.git('log', '-1', f'--format=%(trailers:key={REVISION_TRAILER},valueonly)', self.tip)
+        try:
+            created_at, revision_id = message.split()
+            return datetime.fromisoformat(created_at), revision_id
+        except ValueError:
+            exit_with_error(f'The tip of {self.ref} is not an exported revision: {self.tip}')
+
+    def load_paths(self) -> dict[str, str]:
+        if self.tip is None:
+            return {}
+        try:
+            cache = json.loads(self.cache_path.read_text(encoding='utf-8'))
+            if cache['commit'] == self.tip:
+                self.hidden = cache.get('hidden', {})
+                return cache['paths']
+        except (OSError, ValueError, KeyError):
+            pass
+
+        # replay the log, each commit adding or moving the file of a single note
+        paths = {}
+        log = self.git(
+            'log', '--reverse', '--no-renames', '--name-status', '-z',
+            f'--format=%x01%(trailers:key={NOTE_TRAILER},valueonly)', self.tip,
+        )
+        for commit in log.split('\x01')[1:]:
+            note_id, _, changes = commit.partition('\n')
+            fields = changes.strip('\0\n').split('\0')
+            for status, path in zip(fields[::2], fields[1::2]):
+                if status != 'D':
+                    paths[note_id.strip()] = path
+        return paths
+
+    def save_paths(self) -> None:
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        self.cache_path.write_text(
+            json.dumps({'commit': self.tip, 'paths': self.paths, 'hidden': self.hidden}), encoding='utf-8',
+        )
+
+    def send(self, data: bytes) -> None:
+        if self.fast_import is None:
+            self.fast_import = subprocess.Popen(
+                ['git', 'fast-import', '--quiet'], cwd=self.git_helper.repo_path,
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,  # the responses to cat-blob, ls and progress
+            )
+        self.fast_import.stdin.write(data)  # type: ignore
+
+    def receive(self) -> bytes:
+        self.fast_import.stdin.flush()  # type: ignore
+        return self.fast_import.stdout.readline()  # type: ignore
+
+    def read_note(self, note_id: str) -> str:
+        """Return the content of a note as of its last revision, or an empty string for a new note."""
+        for contents in (self.skipped, self.hidden):
+            if note_id in contents:
+                return contents[note_id]
+        if (path := self.paths.get(note_id)) is None:
+            return ''
+        if (blob := self.blobs.get(path)) is None:  # committed before this run
+            self.send(f'ls {self.tip} {quote_path(path)}\n'.encode('utf-8'))
+            response = self.receive().decode('utf-8')
+            if response.startswith('missing '):
+                return ''
+            blob = response.split()[2]
+        self.send(f'cat-blob {blob}\n'.encode('utf-8'))
+        size = int(self.receive().split()[2])  # <sha> blob <size>
+        data = self.fast_import.stdout.read(size + 1)[:-1]  # type: ignore
+        count('files read')
+        return data.decode('utf-8')
+
+    def skip(self, note_id: str, content: str) -> None:
+        """Keep the content of a revision not committed (e.g. excluded from pushing) for the next one to patch."""
+        self.skipped[note_id] = content
+
+    def commit(self, note_id: str, path: str, content: str, *, message: str, author: tuple[str, str],
+               revision: tuple[datetime, str]) -> None:
+        """Commit a revision of a note, moving it to `path` if needed."""
+        data = content.encode('utf-8')
+        self.send(b'blob\nmark :%d\ndata %d\n%b\n' % (self.next_mark, len(data), data))
+        count('files written')
+        count('bytes written', len(data))
+
+        created_at, revision_id = revision
+        message += f'\n\n{NOTE_TRAILER}: {note_id}\n{REVISION_TRAILER}: {created_at.isoformat()} {revision_id}\n'
+        timestamp = f'{int(created_at.timestamp())} +0000'
+        changes = [f'M 100644 :{self.next_mark} {quote_path(path)}']
+        if (prev_path := self.paths.get(note_id)) not in (None, path):  # re-tagged or re-titled
+            changes.insert(0, f'D {quote_path(prev_path)}')
+        self.send(b''.join([
+            f'commit refs/heads/{self.ref}\n'.encode('utf-8'),
+            f'author {sanitize_ident(author[0])} <{sanitize_ident(author[1])}> {timestamp}\n'.encode('utf-8'),
+            f'committer {self.git_helper.user_name} <{self.git_helper.user_email}> {timestamp}\n'.encode('utf-8'),
+            b'data %d\n%b\n' % (len(message.encode('utf-8')), message.encode('utf-8')),
+            # the first commit only
+            f'from {self.tip}\n'.encode('utf-8') if self.tip and self.next_mark == 1 else b'',
+            *(f'{change}\n'.encode('utf-8') for change in changes),
+            b'\n',
+        ]))
+        # the revisions skipped so far precede this one, i.e. are up to the tip once checkpointed
+        self.hidden.update(self.skipped)
+        self.skipped.clear()
+        self.hidden.pop(note_id, None)
+        self.paths[note_id] = path
+        self.blobs[path] = f':{self.next_mark}'
+        self.next_mark += 1
+        self.pending += 1
+        if self.pending >= configs['DB_BATCH_SIZE']:
+            self.checkpoint()
+
+    def checkpoint(self) -> None:
+        """Update the ref with the commits so far and save the paths, for an interrupted export to resume here."""
+        if not self.pending:
+            return
+        self.send(b'checkpoint\nprogress checkpoint\n')
+        while self.receive().strip() != b'progress checkpoint':
+            continue
+        self.tip = self.git('rev-parse', f'refs/heads/{self.ref}')
+        self.save_paths()
+        self.pending = 0
+
+    @timed('git push')
+    def push(self) -> None:
+        """Finish the export and push the ref to the remote, as a fast-forward."""
+        self.checkpoint()
+        if self.fast_import is not None:
+            self.fast_import.stdin.close()  # type: ignore
+            if self.fast_import.wait():
+                raise git.GitCommandError('git fast-import', self.fast_import.returncode)
+            self.fast_import = None
+        if self.tip is not None:
+            self.git_helper.git_remote.push(f'{self.tip}:refs/heads/{self.ref}').raise_if_error()
+
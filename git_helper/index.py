@@ -0,0 +1,85 @@
+import json
+import typing as t
+from pathlib import Path
+
+from configs import configs
+
+if t.TYPE_CHECKING:
+    from .core import GitHelper
+
+INDEX_PATH = '.hedge2git/index'
+
+
+class IndexEntry(t.TypedDict):
+    id: str  # Note.id, or empty for the notes not pushed from Hedgedoc
+    alias: str
+    title: str
+    tags: list[str]
+    hash: str  # see utils.hash_content
+
+
+class NoteIndex:
+    """The metadata of the notes in the repository by their relative paths, committed along with the notes."""
+
+    def __init__(self, entries: dict[str, IndexEntry] | None = None, path: str = INDEX_PATH) -> None:
+        self.entries = entries or {}
+        self.path = path  # relative to the repository
+        self.changed = False
+
+    @classmethod
+    def load(cls, git_helper: 'GitHelper', prefix: str = '') -> 'NoteIndex':
+        """Return the index of the notes under a directory, or an empty one if it is missing or unreadable."""
+        path = prefix + INDEX_PATH
+        try:
+            lines = git_helper.read_text(path).splitlines()
+            entries = {(entry := json.loads(line)).pop('path'): entry for line in lines if line}
+        except (OSError, ValueError, KeyError, AttributeError):
+            return cls(path=path)
+        return cls(entries, path)
+
+    @staticmethod
+    def get_cache_path() -> Path:
+        return configs['CACHE_DIR'] / 'index.json'
+
+    @classmethod
+    def load_cache(cls) -> 'NoteIndex':
+        """Return the index as of the last scan of the local mirror, see save_cache, or an empty one."""
+        try:
+            entries = json.loads(cls.get_cache_path().read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            return cls()
+        return cls(entries if isinstance(entries, dict) else None)
+
+    def save_cache(self) -> None:
+        """Persist the entries locally, so that the files a scan has read are not read again until they change.
+
+        Unlike the index committed, it also covers the files changed without updating it, e.g. edited by hand.
+        """
+        path = self.get_cache_path()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps(self.entries, ensure_ascii=False), encoding='utf-8')
+        tmp_path.replace(path)
+
+    def get(self, rel_path: str, digest: str) -> IndexEntry | None:
+        """Return the entry of a file unless it is stale, i.e. the file was changed without updating the index."""
+        entry = self.entries.get(rel_path)
+        return entry if entry is not None and entry['hash'] == digest else None
+
+    def set(self, rel_path: str, entry: IndexEntry) -> None:
+        if self.entries.get(rel_path) != entry:
+            self.entries[rel_path] = entry
+            self.changed = True
+
+    def remove(self, rel_path: str) -> None:
+        if self.entries.pop(rel_path, None) is not None:
+            self.changed = True
+
+    def save(self, git_helper: 'GitHelper') -> None:
+        # one line per note sorted by path, so that it diffs well in git
+        lines = (
+            json.dumps({'path': rel_path, **self.entries[rel_path]}, ensure_ascii=False, separators=(',', ':'))
+            for rel_path in sorted(self.entries)
+        )
+        git_helper.write_file(self.path, ''.join(f'{line}\n' for line in lines))
+        self.changed = False
@@ -0,0 +1,56 @@
+import json
+import typing as t
+from pathlib import PurePosixPath
+
+from utils import hash_content
+
+if t.TYPE_CHECKING:
+    from .core import GitHelper
+
+MANIFEST_PATH = '.hedge2git/uploads'
+UPLOADS_DIR = '.hedge2git/blobs/'
+
+
+class UploadManifest:
+    """The files uploaded to Hedgedoc the notes refer to, keyed by their names, committed along with the notes.
+
+    The files are stored content-addressed, i.e. named after their blob hashes, so that a file is stored once
+    however many times it has been uploaded.
+    """
+
+    def __init__(self, entries: dict[str, str] | None = None, path: str = MANIFEST_PATH) -> None:
+        self.entries = entries or {}  # the paths of the files relative to the manifest
+        self.path = path  # relative to the repository
+        self.prefix = path.removesuffix(MANIFEST_PATH)
+        self.changed = False
+
+    @classmethod
+    def load(cls, git_helper: 'GitHelper', prefix: str = '') -> 'UploadManifest':
+        """Return the manifest of the notes under a directory, or an empty one if it is missing or unreadable."""
+        path = prefix + MANIFEST_PATH
+        try:
+            lines = git_helper.read_text(path).splitlines()
+            entries = {(entry := json.loads(line))['name']: entry['path'] for line in lines if line}
+        except (OSError, ValueError, KeyError, TypeError):
+            return cls(path=path)
+        return cls(entries, path)
+
+    def get(self, name: str) -> str | None:
+        """Return the path of an uploaded file relative to the repository, or None if not stored yet."""
+        rel_path = self.entries.get(name)
+        return self.prefix + rel_path if rel_path is not None else None
+
+    def add(self, name: str, data: bytes) -> str:
+        """Record an uploaded file and return the path it is to be stored at relative to the repository."""
+        rel_path = UPLOADS_DIR + hash_content(data) + PurePosixPath(name).suffix
+        if self.entries.get(name) != rel_path:
+            self.entries[name] = rel_path
+            self.changed = True
+        return self.prefix + rel_path
+
+    def save(self, git_helper: 'GitHelper') -> None:
+        git_helper.write_file(self.path, ''.join(
+            json.dumps({'name': name, 'path': self.entries[name]}, separators=(',', ':')) + '\n'
+            for name in sorted(self.entries)
+        ))
+        self.changed = False
@@ -1,9 +1,41 @@
+import cProfile
+import json
+import sys
+import time
 from datetime import datetime
+from pathlib import Path
 
 import click
 
-import _helpers
-from hedgedoc.core import hedgedoc
+from archive import is_supported
+from configs import configs
+from utils import exit_with_error, get_report, is_initialized, lock_dir, timed, timings
+
+start_time = time.perf_counter()
+
+
+def validate(**actions: str | bool | None) -> None:
+    # the credentials are validated on the first use of hedgedoc, as not every action needs it
+    if actions['pull'] and actions['push'] is not None:
+        exit_with_error("Got both 'pull' and 'push'")
+    if actions['sync'] is not None and (actions['pull'] or actions['push'] is not None or actions['watch']):
+        exit_with_error("Got 'sync' along with 'pull', 'push' or 'watch'")
+    if actions['sync'] is not None and (actions['plan'] or actions['apply']):
+        exit_with_error("Got 'sync' along with 'plan' or 'apply'")
+    if actions['watch'] and (actions['pull'] or actions['push'] is not None):
+        exit_with_error("Got 'watch' along with 'pull' or 'push'")
+    if actions['users'] is not None and actions['push'] is None:
+        exit_with_error("Got 'users' without 'push'")
+    if actions['plan'] and (actions['pull'] == (actions['push'] is not None) or actions['users'] is not None):
+        exit_with_error("Got 'plan' without either 'pull' or 'push' (of a single user)")
+    if actions['apply'] and (
+        actions['pull'] or actions['push'] is not None or actions['watch'] or actions['plan']
+    ):
+        exit_with_error("Got 'apply' along with 'pull', 'push', 'watch' or 'plan'")
+    if actions['apply'] and actions['dry_run']:
+        exit_with_error("Got 'apply' along with 'dry-run', the plan is the dry run")
+    if actions['export'] and not is_supported(Path(actions['export'])):  # type: ignore
+        exit_with_error(f"Unsupported archive: {actions['export']}")
 
 
 @click.command()
@@ -24,6 +56,37 @@ from hedgedoc.core import hedgedoc
     default=None, show_default=True,
     help='Push changes.',
 )
+@click.option(
+    '--sync', 'sync', metavar='COMMENT',
+    is_flag=False, flag_value=datetime.now().strftime('Synced at %Y-%m-%d %H:%M:%S'),
+    default=None, show_default=True,
+    help='Sync the changes of both sides since the last sync at once, reporting the notes changed on both.',
+)
+@click.option(
+    '--users', 'users', metavar='EMAILS',
+    is_flag=False, flag_value='*', default=None,
+    help='Push the notes of all or the given (comma-separated) users, each under .hedge2git/users/EMAIL/.',
+)
+@click.option(
+    '--plan', 'plan', metavar='FILE',
+    type=click.Path(dir_okay=False, writable=True), default=None,
+    help='Write the changes --pull/--push is to make into a JSON plan instead of making them, see --apply.',
+)
+@click.option(
+    '--apply', 'apply', metavar='FILE',
+    type=click.Path(exists=True, dir_okay=False), default=None,
+    help='Make the changes of a plan, unless the notes or files they touch have changed since it was written.',
+)
+@click.option(
+    '--export', 'export', metavar='FILE',
+    type=click.Path(dir_okay=False, writable=True), default=None,
+    help='Export the notes into an archive laid out as the repository: .zip, .tar.zst, .tar.gz or .tar.',
+)
+@click.option(
+    '--export-history', 'export_history',
+    is_flag=True, default=False, show_default=True,
+    help='Commit the revisions made since the last export onto GIT_HISTORY_REF, one commit per revision.',
+)
 @click.option(
     '--overwrite', 'overwrite',
     is_flag=True, default=False, show_default=True,
@@ -39,26 +102,112 @@ from hedgedoc.core import hedgedoc
     is_flag=True, default=False, show_default=True,
     help='Refresh the alias of each note based on the tags.',
 )
+@click.option(
+    '--watch', 'watch',
+    is_flag=True, default=False, show_default=True,
+    help='Keep running and push the notes whenever they change.',
+)
+@click.option(
+    '--watch-interval', 'watch_interval', metavar='SECONDS',
+    type=float, default=5.0, show_default=True,
+    help='How often --watch polls the database for changes.',
+)
+@click.option(
+    '--watch-debounce', 'watch_debounce', metavar='SECONDS',
+    type=float, default=2.0, show_default=True,
+    help='How long --watch waits for the changes to settle before pushing them.',
+)
 @click.option(
     '--dry-run', 'dry_run', is_flag=True,
     help='Show the files to be pulled/pushed without actually pulling/pushing them.',
 )
+@click.option(
+    '--timings', 'timings', is_flag=True,
+    help='Print the time spent in each phase to stderr.',
+)
+@click.option(
+    '--profile', 'profile', metavar='FILE',
+    type=click.Path(dir_okay=False, writable=True), default=None,
+    help='Write the time spent and the SQL, HTTP and file operations of each phase to a JSON file.',
+)
+@click.option(
+    '--profile-stats', 'profile_stats', metavar='FILE',
+    type=click.Path(dir_okay=False, writable=True), default=None,
+    help='Write the cProfile statistics of the run to a file, see pstats.',
+)
 def hedge2git(**actions: str | bool):
     """
     Sync hedgedoc via Git registries. Use .env to configure repository, access token, etc.
     """
-    _helpers.validate(**actions)
+    validate(**actions)
+    lock_dir(configs['CACHE_DIR'])  # the runs sharing the local mirror and the sync state never overlap
 
-    if actions['pull']:
-        _helpers.pull(overwrite=actions['overwrite'], dry_run=actions['dry_run'])  # type: ignore
+    if actions['profile_stats']:
+        profiler = cProfile.Profile()
+        profiler.enable()
 
-    if (comment := actions['push']) is not None:
-        _helpers.push(comment, overwrite=actions['overwrite'], dry_run=actions['dry_run'])  # type: ignore
+    with timed('import'):  # import the heavy dependencies here, so that --help stays fast
+        import _helpers
+        from hedgedoc import hedgedoc
+
+    if actions['plan']:
+        with timed('plan'):
+            _helpers.plan(Path(actions['plan']), actions['push'], overwrite=actions['overwrite'])  # type: ignore
+    elif actions['pull']:
+        with timed('pull'):
+            _helpers.pull(overwrite=actions['overwrite'], dry_run=actions['dry_run'])  # type: ignore
+
+    if actions['watch']:
+        _helpers.watch(
+            overwrite=actions['overwrite'], dry_run=actions['dry_run'],  # type: ignore
+            interval=actions['watch_interval'], debounce=actions['watch_debounce'],  # type: ignore
+        )
+
+    if (comment := actions['push']) is not None and (users := actions['users']) is not None:
+        with timed('push'):
+            _helpers.push_users(
+                comment, None if users == '*' else users.split(','),  # type: ignore
+                overwrite=actions['overwrite'], dry_run=actions['dry_run'],  # type: ignore
+            )
+    elif comment is not None and not actions['plan']:
+        with timed('push'):
+            _helpers.push(comment, overwrite=actions['overwrite'], dry_run=actions['dry_run'])  # type: ignore
+
+    if (comment := actions['sync']) is not None:
+        with timed('sync'):
+            _helpers.sync(comment, dry_run=actions['dry_run'])  # type: ignore
+
+    if actions['apply']:
+        with timed('apply'):
+            _helpers.apply(Path(actions['apply']))  # type: ignore
+
+    if actions['export']:
+        with timed('export'):
+            _helpers.export(Path(actions['export']), dry_run=actions['dry_run'])  # type: ignore
+
+    if actions['export_history']:
+        with timed('export history'):
+            _helpers.export_history(dry_run=actions['dry_run'])  # type: ignore
 
-    if actions['refresh_history']:
-        hedgedoc.refresh_history()
     if actions['refresh_alias']:
         hedgedoc.refresh_alias()  # type: ignore
+    if actions['refresh_history']:
+        hedgedoc.history_stale = True
+
+    # the operations above only mark the history stale, so that it is rebuilt at most once per run
+    if is_initialized(hedgedoc):
+        hedgedoc.flush_history()
+
+    timings['total'] = time.perf_counter() - start_time
+    if actions['timings']:
+        for phase, seconds in timings.items():
+            print(f'{phase}: {seconds:.3f}s', file=sys.stderr)
+    if actions['profile']:
+        with open(actions['profile'], 'w', encoding='utf-8') as f:  # type: ignore
+            json.dump(get_report(), f, indent=2)
+    if actions['profile_stats']:
+        profiler.disable()
+        profiler.dump_stats(actions['profile_stats'])
 
 
 if __name__ == '__main__':
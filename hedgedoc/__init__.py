@@ -1,21 +1,58 @@
 import pathlib
+import typing as t
+import uuid
+
+from configs import configs
 
 from .core import hedgedoc
-from .models import Note
+from .models import Note, Revision, User
+
+
+def read_file(path: str) -> str:
+    return pathlib.Path(path).read_text(encoding='utf-8')
 
 
-def create_notes(paths: list[pathlib.Path], dry_run: bool) -> None:
+def create_notes(paths: list[pathlib.Path], dry_run: bool,
+                 read_text: t.Callable[[str], str] = read_file) -> None:
     """Create Hedgedoc notes for a given list of Markdown files."""
     print('Creating notes...')
-    for path in paths:
-        content = path.read_text(encoding='utf-8')
-        alias = Note.get_alias(title=path.stem, content=content)
-        print(f'\t{path.stem} ({alias})')
-        if not dry_run:
-            hedgedoc.add_note(title=path.stem, content=content, alias=alias)
 
-    if not dry_run:
-        hedgedoc.refresh_history()
+    def read_notes() -> t.Iterator[dict[str, str]]:
+        for path in paths:
+            content = read_text(path.as_posix())
+            alias = Note.get_alias(title=path.stem, content=content)
+            print(f'\t{path.stem} ({alias})')
+            yield {'title': path.stem, 'content': content, 'alias': alias}
+
+    notes = read_notes()  # read lazily chunk by chunk
+    add_notes = hedgedoc.post_notes if configs['CREATE_NOTES_VIA'] == 'api' else hedgedoc.add_notes
+    results = [True for _ in notes] if dry_run else add_notes(notes)
+    for path, created in zip(paths, results):
+        if created is False:  # None if failed
+            print(f'\t{path.stem} already exists, skipped')
+
+    if not dry_run and any(results):
+        hedgedoc.history_stale = True
+
+
+def update_notes(paths: dict[uuid.UUID, pathlib.Path], dry_run: bool,
+                 read_text: t.Callable[[str], str] = read_file) -> None:
+    """Replace the content of Hedgedoc notes given by their ids with the Markdown files, and re-alias them."""
+    print('Updating notes...')
+
+    def read_notes() -> t.Iterator[dict[str, t.Any]]:
+        for note_id, path in paths.items():
+            print(f'\t{path.stem} ({path.as_posix()})')
+            yield {'id': note_id, 'title': path.stem, 'content': read_text(path.as_posix())}
+
+    notes = read_notes()  # read lazily chunk by chunk
+    if dry_run:
+        list(notes)
+        return
+    hedgedoc.update_notes(notes)
+    if paths:
+        hedgedoc.refresh_alias(hedgedoc.get_notes(ids=paths))
+        hedgedoc.history_stale = True
 
 
 def delete_notes(notes: list[Note], dry_run: bool) -> None:
@@ -26,5 +63,6 @@ def delete_notes(notes: list[Note], dry_run: bool) -> None:
         if not dry_run:
             hedgedoc.session.delete(note)
 
-    if not dry_run:
-        hedgedoc.refresh_history()
+    if not dry_run and notes:
+        hedgedoc.session.commit()
+        hedgedoc.history_stale = True
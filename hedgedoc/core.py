@@ -1,30 +1,43 @@
 import json
+import random
+import re
+import selectors
+import threading
+import time
 import typing as t
 import uuid
+from collections import Counter, defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
+from itertools import batched
 from urllib.parse import urlencode
 
 import httpx
 from parse import parse
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import Row, and_, case, create_engine, event, func, insert, or_, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import scoped_session, sessionmaker
 
 from configs import configs
-from utils import exit_with_error
+from utils import Lazy, count, exit_with_error, submit, timed
 
-from .models import Note, T_Base, User
+from .models import Note, Revision, T_Base, User
 
 
 class HedgedocStore:
     def __init__(self) -> None:
-        db_type = configs['DB_TYPE']
-        db_user = configs['DB_USER']
-        db_pass = configs['DB_PASS']
-        db_host = configs['DB_HOST']
-        db_port = configs['DB_PORT']
-        db_name = configs['DB_NAME']
-        engine = create_engine(f'{db_type}://{db_user}:{db_pass}@{db_host}:{db_port}/{db_name}', future=True)
-        self.session = sessionmaker(bind=engine)()
+        if not (db_url := configs.get('DB_URL')):
+            db_type = configs['DB_TYPE']
+            db_user = configs['DB_USER']
+            db_pass = configs['DB_PASS']
+            db_host = configs['DB_HOST']
+            db_port = configs['DB_PORT']
+            db_name = configs['DB_NAME']
+            db_url = f'{db_type}://{db_user}:{db_pass}@{db_host}:{db_port}/{db_name}'
+        engine = create_engine(db_url, future=True)
+        event.listen(engine, 'before_cursor_execute', lambda *args: count('sql statements'))
+        self.session = scoped_session(sessionmaker(bind=engine))  # a session per thread sharing the engine
+        self.listener = None  # the connection listening to DB_NOTIFY_CHANNEL, see wait_for_changes
 
     def get_or_create(self, model: type[T_Base], defaults: dict = {}, **kwargs) -> tuple[T_Base, bool]:
         obj = self.session.query(model).filter_by(**kwargs).first()
@@ -36,15 +49,105 @@ class HedgedocStore:
         self.session.commit()
         return obj, True
 
+    def bulk_update(self, model: type[T_Base], rows: list[dict[str, t.Any]]) -> None:
+        """Update rows by their primary keys in chunks without committing."""
+        for chunk in batched(rows, configs['DB_BATCH_SIZE']):
+            self.session.execute(update(model), list(chunk))  # UPDATE ... WHERE id = ... (executemany)
+
+    def insert_or_ignore(self, model: type[T_Base], rows: list[dict[str, t.Any]], key: str) -> set[t.Any]:
+        """Insert rows in one statement without committing, skipping the conflicting ones.
+
+        Return the values of the column `key` of the inserted rows.
+        """
+        column = getattr(model, key)
+        if self.session.bind.dialect.name == 'postgresql':  # type: ignore
+            # INSERT ... ON CONFLICT DO NOTHING RETURNING ...
+            stmt = pg_insert(model).on_conflict_do_nothing().returning(column)
+            return set(self.session.scalars(stmt, rows))
+
+        self.session.execute(insert(model), rows)
+        return {row[key] for row in rows}
+
+    def get_change_token(self, owner: User | None = None) -> tuple[t.Any, ...]:
+        """Return a fingerprint of the notes (of a given user) changing on any insertion, update or deletion."""
+        query = select(func.max(Note.updated_at), func.count(Note.id))
+        if owner is not None:
+            query = query.where(Note.owner_id == owner.id)
+        # a connection of its own, so that the session is neither kept in a transaction nor expired between polls
+        with self.session.bind.connect() as connection:  # type: ignore
+            return tuple(connection.execute(query).one())
+
+    def wait_for_changes(self, timeout: float) -> None:
+        """Wait up to `timeout` seconds for a notification on DB_NOTIFY_CHANNEL, or simply sleep without one."""
+        channel = configs['DB_NOTIFY_CHANNEL']
+        if channel is None or self.session.bind.dialect.name != 'postgresql':  # type: ignore
+            time.sleep(timeout)
+            return
+
+        if self.listener is None:
+            self.listener = self.session.bind.raw_connection()  # type: ignore
+            self.listener.driver_connection.autocommit = True
+            with self.listener.cursor() as cursor:
+                cursor.execute(f'LISTEN {channel}')
+        connection = self.listener.driver_connection
+        with selectors.DefaultSelector() as selector:
+            selector.register(connection, selectors.EVENT_READ)
+            if selector.select(timeout):
+                connection.poll()
+                connection.notifies.clear()
+
 
 class HedgedocAPI:
     def __init__(self) -> None:
         self.server = httpx.URL(configs['HEDGEDOC_SERVER'])
-        self.client = httpx.Client()
+        # the uploads referred to by the absolute URLs of the server or by the paths relative to it
+        self.upload_pattern = re.compile(rf'(?:{re.escape(str(self.server))}|(?<![\w/.-])/)uploads/([\w.-]+)')
+        concurrency = configs['HTTP_CONCURRENCY']
+        if configs['HTTP2']:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                exit_with_error('HTTP2 requires h2, e.g. `pipenv install httpx[http2]`')
+        self.client = httpx.Client(
+            http2=configs['HTTP2'],
+            limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency),
+            event_hooks={'request': [self.count_request], 'response': [self.count_response]},
+        )
         self.client.post(self.server.join('login'), data={
             'email': configs['HEDGEDOC_USER'],
             'password': configs['HEDGEDOC_PASS'],
         })
+        if self.GET('me').json()['status'] == 'forbidden':
+            exit_with_error('Invalid email or password')
+
+    @staticmethod
+    def count_request(request: httpx.Request) -> None:
+        count('http requests')
+        count('http bytes sent', int(request.headers.get('Content-Length', 0)))  # without reading a stream
+
+    @staticmethod
+    def count_response(response: httpx.Response) -> None:
+        response.read()
+        count('http bytes received', len(response.content))
+
+    def send(self, method: str, api: str, **kwargs: t.Any) -> httpx.Response:
+        """Send a request, retrying it with an exponential backoff on 429, 5xx or a connection error."""
+        retries = configs['HTTP_RETRIES']
+        for attempt in range(retries + 1):
+            delay = 0.5 * 2 ** attempt * random.uniform(0.5, 1.5)  # jittered, so that the retries spread out
+            try:
+                response = self.client.request(method, self.server.join(api), **kwargs)
+            except httpx.TransportError:
+                if attempt == retries:
+                    raise
+            else:
+                if response.status_code != 429 and response.status_code < 500 or attempt == retries:
+                    return response
+                if (retry_after := response.headers.get('Retry-After', '')).isdigit():
+                    delay = float(retry_after)
+            count('http retries')
+            time.sleep(min(delay, 60))
+        raise AssertionError('unreachable')
 
     def GET(self, api: str) -> httpx.Response:
         return self.client.get(self.server.join(api))
@@ -61,91 +164,387 @@ class Hedgedoc(HedgedocAPI, HedgedocStore):
     def __init__(self) -> None:
         HedgedocAPI.__init__(self)
         HedgedocStore.__init__(self)
+        self.history_stale = False  # see flush_history
+        self.alias_lock = threading.Lock()  # aliases are unique across the users synced concurrently
 
     # operations for Hedgedoc notes
-    def get_notes(self, owner: User | None = None) -> list[Note]:
-        """Return a list of notes for a given user which default to the current logged-in user."""
-        if owner is None:
-            return self.session.query(Note).all()
-        return self.session.query(Note).filter(Note.owner_id == owner.id).all()
+    @timed('get notes')
+    def get_notes(self, owner: User | None = None, *, updated_since: datetime | None = None,
+                  ids: t.Iterable[uuid.UUID] | None = None) -> list[Note]:
+        """Return a list of notes for a given user, optionally only the ones updated since a given time."""
+        query = self.session.query(Note)
+        if ids is not None:
+            query = query.filter(Note.id.in_(ids))
+        if owner is not None:
+            query = query.filter(Note.owner_id == owner.id)
+        if updated_since is not None:
+            query = query.filter(Note.updated_at >= updated_since)
+        return query.all()
+
+    def iter_notes(self, owner: User | None = None, *, updated_since: datetime | None = None,
+                   with_content: bool = False) -> t.Iterator[Row]:
+        """Stream the notes with only the columns needed to diff them, plus their content if `with_content`."""
+        query = select(
+            Note.id, Note.short_id, Note.alias,
+            case((Note._title == 'Untitled', ''), else_=Note._title).label('title'),  # as Note.title
+            Note.created_at, Note.updated_at, Note.owner_id,
+            *([Note.content] if with_content else []),
+        )
+        if owner is not None:
+            query = query.where(Note.owner_id == owner.id)
+        if updated_since is not None:
+            query = query.where(Note.updated_at >= updated_since)
+        yield from self.session.execute(query, execution_options={'yield_per': configs['DB_BATCH_SIZE']})
+
+    def get_contents(self, note_ids: t.Iterable[uuid.UUID]) -> t.Iterator[tuple[uuid.UUID, str]]:
+        """Fetch the content of the given notes in batches."""
+        for chunk in batched(note_ids, configs['DB_BATCH_SIZE']):
+            query = select(Note.id, Note.content).where(Note.id.in_(chunk))
+            yield from self.session.execute(query)  # type: ignore
+
+    @timed('get note ids')
+    def get_note_ids(self, owner: User | None = None) -> set[str]:
+        """Return the IDs of the notes for a given user without loading the notes."""
+        query = self.session.query(Note.id)
+        if owner is not None:
+            query = query.filter(Note.owner_id == owner.id)
+        return {str(note_id) for note_id, in query}
 
     def get_note(self, alias: str) -> Note:
         return self.session.query(Note).filter(Note.alias == alias).first()  # type: ignore
 
     def add_note(self, title: str, content: str, alias: str) -> None:
-        # if not content:
-        #     resp = self.GET('new')
-        # elif not alias:
-        #     resp = self.POST('new', content=content, content_type='text/markdown')
-        # else:
-        # resp = self.POST(f'new/{alias}', content=content, content_type='text/markdown')
-        # resp.raise_for_status()
-        note = {
-            'short_id': alias,
-            'alias': alias,
-        }
-        self.get_or_create(Note, **note, defaults={
-            'id': uuid.uuid4(),
-            '_title': title,
-            'content': content,
-            'created_at': datetime.now(),
-            'owner_id': hedgedoc.get_current_user().id,
-        })
+        add_notes = self.post_notes if configs['CREATE_NOTES_VIA'] == 'api' else self.add_notes
+        add_notes([{'title': title, 'content': content, 'alias': alias}])
+
+    def get_taken_aliases(self, aliases: t.Iterable[str]) -> set[str]:
+        """Return the given aliases taken by existing notes, as aliases or short IDs."""
+        aliases = set(aliases)
+        query = select(Note.alias, Note.short_id).where(or_(Note.alias.in_(aliases), Note.short_id.in_(aliases)))
+        return {value for row in self.session.execute(query) for value in row}.intersection(aliases)
+
+    @timed('add notes')
+    def add_notes(self, notes: t.Iterable[dict[str, str]]) -> list[bool]:
+        """Create notes in chunks within a single transaction, skipping the ones whose alias already exists.
+
+        Return whether each note is created in the given order.
+        """
+        owner_id = self.get_current_user().id
+        now = datetime.now().astimezone()
+        aliases: set[str] = set()  # the aliases taken so far
+        created = []
+        try:
+            for chunk in batched(notes, configs['DB_BATCH_SIZE']):
+                aliases.update(self.get_taken_aliases({note['alias'] for note in chunk}))
+
+                rows: list[dict[str, t.Any] | None] = []  # aligned with the chunk
+                for note in chunk:
+                    if note['alias'] in aliases:
+                        rows.append(None)
+                        continue
+                    aliases.add(note['alias'])
+                    rows.append({
+                        'id': uuid.uuid4(),
+                        'short_id': note['alias'],
+                        'alias': note['alias'],
+                        '_title': note['title'],
+                        'content': note['content'],
+                        'created_at': now,
+                        'updated_at': now,  # so that the next incremental push picks it up
+                        'owner_id': owner_id,
+                    })
+                new_rows = [row for row in rows if row is not None]
+                inserted = self.insert_or_ignore(Note, new_rows, 'id') if new_rows else set()
+                created += [row is not None and row['id'] in inserted for row in rows]
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+        return created
+
+    def post_note(self, note: dict[str, str]) -> str | None:
+        """Create a note through the API, and return the error if failed."""
+        try:
+            response = self.send(
+                'POST', f'new/{note["alias"]}',
+                content=note['content'].encode('utf-8'), headers={'Content-Type': 'text/markdown'},
+            )
+        except httpx.HTTPError as e:
+            return f'{type(e).__name__}: {e}'
+        return f'HTTP {response.status_code}' if response.is_error else None  # redirected to the note if created
+
+    @timed('post notes')
+    def post_notes(self, notes: t.Iterable[dict[str, str]]) -> list[bool | None]:
+        """Create notes through the API concurrently in chunks, skipping the ones whose alias already exists.
+
+        Unlike add_notes, Hedgedoc does its own bookkeeping of the notes. Return whether each note is created in
+        the given order, or None for the ones failed (reported as they fail).
+        """
+        aliases: set[str] = set()  # the aliases taken so far
+        created: list[bool | None] = []
+        with ThreadPoolExecutor(configs['HTTP_CONCURRENCY']) as executor:
+            for chunk in batched(notes, configs['DB_BATCH_SIZE']):
+                aliases.update(self.get_taken_aliases({note['alias'] for note in chunk}))
+                futures: list[Future[str | None] | None] = []  # aligned with the chunk
+                for note in chunk:
+                    if note['alias'] in aliases:
+                        futures.append(None)
+                        continue
+                    aliases.add(note['alias'])
+                    futures.append(submit(executor, self.post_note, note))
 
-    def get_ref_id(self, note: Note) -> str:
+                titles = {}
+                for note, future in zip(chunk, futures):
+                    if future is None:
+                        created.append(False)
+                    elif (error := future.result()) is not None:
+                        print(f'\t{note["title"]} ({note["alias"]}) failed: {error}')
+                        created.append(None)
+                    else:
+                        titles[note['alias']] = note['title']
+                        created.append(True)
+
+                # Hedgedoc titles a note once it is edited, while the notes are titled after their files here
+                query = select(Note.id, Note.alias).where(Note.alias.in_(titles))
+                self.bulk_update(Note, [
+                    {'id': note_id, '_title': titles[alias]} for note_id, alias in self.session.execute(query)
+                ])
+                self.session.commit()
+        return created
+
+    @timed('update notes')
+    def update_notes(self, notes: t.Iterable[dict[str, t.Any]]) -> None:
+        """Replace the title and content of notes given by their ids in chunks within a single transaction."""
+        now = datetime.now().astimezone()
+        try:
+            for chunk in batched(notes, configs['DB_BATCH_SIZE']):
+                self.bulk_update(Note, [
+                    {'id': note['id'], '_title': note['title'], 'content': note['content'], 'updated_at': now}
+                    for note in chunk
+                ])
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+
+    def get_ref_id(self, note: Note | Row) -> str:
         """Return the URL-referenced ID given a Note.short_id or Note.alias."""
         if note.alias is not None:
             return note.alias  # type: ignore
         return parse(f'{self.server}{{}}', self.GET(note.short_id).headers['location'])[0]  # type: ignore
 
+    @timed('get ref ids')
+    def get_ref_ids(self, notes: t.Iterable[Note | Row]) -> dict[uuid.UUID, str]:
+        """Return the URL-referenced IDs of notes keyed by Note.id, resolving the short IDs concurrently.
+
+        The short IDs resolved are cached across runs until the notes are aliased.
+        """
+        cache_path = configs['CACHE_DIR'] / 'refs.json'
+        try:
+            cache = json.loads(cache_path.read_text(encoding='utf-8'))
+            cached_refs = cache['refs'] if cache['server'] == str(self.server) else {}
+        except (OSError, ValueError, KeyError):
+            cached_refs = {}
+
+        ref_ids = {}
+        refs = {}  # the refs of the notes without aliases keyed by their short IDs
+        unresolved = {}
+        for note in notes:
+            if note.alias is not None:
+                ref_ids[note.id] = note.alias
+            elif note.short_id in cached_refs:
+                ref_ids[note.id] = refs[note.short_id] = cached_refs[note.short_id]
+            else:
+                unresolved[note.id] = note
+        with ThreadPoolExecutor(configs['HTTP_CONCURRENCY']) as executor:
+            futures = {note_id: submit(executor, self.get_ref_id, note) for note_id, note in unresolved.items()}
+            for note_id, future in futures.items():
+                ref_ids[note_id] = refs[unresolved[note_id].short_id] = future.result()
+
+        if refs != cached_refs:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            cache_path.write_text(json.dumps({'server': str(self.server), 'refs': refs}), encoding='utf-8')
+        return ref_ids
+
+    # operations for Hedgedoc uploads
+    def get_upload_names(self, content: str) -> set[str]:
+        """Return the names of the uploaded files a note refers to, e.g. `![](/uploads/upload_x.png)`."""
+        return set(self.upload_pattern.findall(content))
+
+    def has_upload(self, name: str) -> bool:
+        return self.client.head(self.server.join(f'uploads/{name}'), follow_redirects=True).status_code == 200
+
+    def get_upload(self, name: str) -> bytes | None:
+        """Download an uploaded file, or return None if it is not found or fails (reported as it fails)."""
+        try:
+            response = self.send(
+                'GET', f'uploads/{name}', follow_redirects=True, timeout=configs['HTTP_UPLOAD_TIMEOUT'],
+            )
+        except httpx.HTTPError as e:  # e.g. timed out, so that a single file cannot fail the notes
+            print(f'\t{name} failed: {e!r}')
+            return None
+        return response.content if response.status_code == 200 else None
+
+    def get_uploads(self, names: t.Iterable[str]) -> t.Iterator[tuple[str, bytes | None]]:
+        """Download uploaded files concurrently as they are consumed, yielding None for the ones missing."""
+        concurrency = configs['HTTP_CONCURRENCY']
+        with ThreadPoolExecutor(concurrency) as executor:
+            pending: deque[tuple[str, Future[bytes | None]]] = deque()
+            for name in names:
+                pending.append((name, submit(executor, self.get_upload, name)))
+                if len(pending) >= 2 * concurrency:  # bound the files held in memory
+                    name, future = pending.popleft()
+                    yield name, future.result()
+            for name, future in pending:
+                yield name, future.result()
+
+    def add_upload(self, name: str, data: bytes) -> str:
+        """Upload a file as an image, and return the name the server stored it under."""
+        response = self.client.post(self.server.join('uploadimage'), files={'image': (name, data)})
+        return response.json()['link'].rsplit('/', 1)[-1]
+
+    # operations for Hedgedoc revisions
+    def iter_revisions(self, owner: User | None = None, *,
+                       since: tuple[datetime, str] | None = None) -> t.Iterator[Row]:
+        """Stream the revisions of the notes in the order made, optionally only the ones after `since`."""
+        query = select(
+            Revision.id, Revision.note_id, Revision.patch, Revision.last_content, Revision.content,
+            Revision.authorship, Revision.created_at, Note.owner_id,
+            # the current title, as Note.title
+            case((Note._title == 'Untitled', ''), else_=Note._title).label('title'),
+        ).join(Note, Note.id == Revision.note_id).order_by(Revision.created_at, Revision.id)
+        if owner is not None:
+            query = query.where(Note.owner_id == owner.id)
+        if since is not None:
+            created_at, revision_id = since
+            query = query.where(or_(
+                Revision.created_at > created_at,
+                and_(Revision.created_at == created_at, Revision.id > uuid.UUID(revision_id)),
+            ))
+        yield from self.session.execute(query, execution_options={'yield_per': configs['DB_BATCH_SIZE']})
+
     # operations for Hedgedoc history
     def get_history(self) -> list[dict[str, t.Any]]:
         return self.GET('history').json()['history']
 
     # operations for Hedgedoc users
-    def get_users(self) -> list[User]:
-        return self.session.query(User).all()
+    def get_users(self, emails: t.Iterable[str] | None = None) -> list[User]:
+        query = self.session.query(User)
+        if emails is not None:
+            query = query.filter(User.email.in_(emails))
+        return query.all()
 
+    @timed('get current user')
     def get_current_user(self) -> User:
         if configs['HEDGEDOC_USER'] is None:
             exit_with_error('HEDGEDOC_USER is not set')
         return self.session.query(User).filter(User.email == configs['HEDGEDOC_USER']).first()  # type: ignore
 
-    def refresh_alias(self, notes: list[Note] | None = None, dry_run: bool = False):
-        """Re-alias notes based on their tags and title."""
-        notes = notes or self.get_notes()
+    @timed('refresh alias')
+    def refresh_alias(self, notes: t.Iterable[Note] | None = None, dry_run: bool = False, *,
+                      owner: User | None = None, updated_since: datetime | None = None,
+                      ) -> dict[uuid.UUID, tuple[str | None, str]]:
+        """Re-alias notes based on their tags and title, defaulting to all the notes (of a given user).
+
+        Return the current and new aliases of the notes re-aliased, or to be re-aliased if `dry_run`.
+        """
         print('Re-aliasing notes... (this will affect the currently viewing notes)')
-        for note in notes:
-            alias = Note.get_alias(title=note.title, tags=note.tags)
-            if alias == note.alias:
-                continue
-
-            print(f'\t{note.title} ({note.alias} -> {alias})')
-            if not dry_run:
-                note.alias = alias  # type: ignore
-                note.short_id = alias  # type: ignore
+        if notes is None:
+            rows = {row.id: row for row in self.iter_notes(owner, updated_since=updated_since)}
+            notes_info = [
+                (note_id, rows[note_id].alias, rows[note_id].title, Note.get_tags(content or ''))
+                for note_id, content in self.get_contents(rows)
+            ]
+        else:
+            notes_info = [(note.id, note.alias, note.title, note.tags) for note in notes]
+
+        titles = {}
+        aliases = {}  # the new aliases keyed by note ids
+        current_aliases = {}
+        for note_id, current_alias, title, tags in notes_info:
+            alias = Note.get_alias(title=title, tags=tags)
+            if alias != current_alias:
+                titles[note_id] = title
+                aliases[note_id] = alias
+                current_aliases[note_id] = current_alias
+
+        with self.alias_lock:  # from checking the collisions until committing the new aliases
+            # `alias` and `shortid` are unique, so skip the notes whose new aliases are kept by the others
+            holders = defaultdict(set)  # note ids keyed by the aliases or short ids they hold
+            for chunk in batched(set(aliases.values()), configs['DB_BATCH_SIZE']):
+                query = select(Note.id, Note.alias, Note.short_id).where(
+                    or_(Note.alias.in_(chunk), Note.short_id.in_(chunk)),
+                )
+                for note_id, alias, short_id in self.session.execute(query):
+                    holders[alias].add(note_id)
+                    holders[short_id].add(note_id)
+            collisions = {}
+            while True:  # until no skipped note keeps an alias that the others are changed to
+                counts = Counter(aliases.values())
+                taken = [
+                    note_id for note_id, alias in aliases.items()
+                    if counts[alias] > 1
+                    or any(holder != note_id and holder not in aliases for holder in holders.get(alias, ()))
+                ]
+                if not taken:
+                    break
+                for note_id in taken:
+                    collisions[note_id] = aliases.pop(note_id)
+
+            for note_id, alias in collisions.items():
+                change = f'{current_aliases[note_id]} -> {alias}'
+                print(f'\t{titles[note_id]} ({change}) collides with another note, skipped')
+            for note_id, alias in aliases.items():
+                print(f'\t{titles[note_id]} ({current_aliases[note_id]} -> {alias})')
+            if dry_run or not aliases:
+                return {note_id: (current_aliases[note_id], alias) for note_id, alias in aliases.items()}
+
+            try:
+                # aliases being swapped between notes have to be released first
+                if any(holders.get(alias, set()) - {note_id} for note_id, alias in aliases.items()):
+                    self.bulk_update(Note, [
+                        {'id': note_id, 'alias': f'~{note_id}', 'short_id': f'~{note_id}'} for note_id in aliases
+                    ])
+                self.bulk_update(Note, [
+                    {'id': note_id, 'alias': alias, 'short_id': alias} for note_id, alias in aliases.items()
+                ])
                 self.session.commit()
+            except Exception:
+                self.session.rollback()
+                raise
+
+        self.history_stale = True
+        return {note_id: (current_aliases[note_id], alias) for note_id, alias in aliases.items()}
 
-        if not dry_run:
+    def flush_history(self) -> None:
+        """Refresh the browsing history once if any operation so far has made it stale."""
+        if self.history_stale:
             self.refresh_history()
 
+    @timed('refresh history')
     def refresh_history(self, history: t.Iterable[dict] | None = None) -> None:
         """Refresh the browsing history based on the database."""
-        history = history or [
-            {
-                'id': self.get_ref_id(note),
-                'text': note.title,
-                'time': int(datetime.now().timestamp()),
-                'tags': note.tags,
-            }
-            for note in self.get_notes()
-        ]
+        if not history:
+            notes = list(self.iter_notes())
+            ref_ids = self.get_ref_ids(notes)
+            tags = {note_id: Note.get_tags(content or '') for note_id, content in self.get_contents(ref_ids)}
+            now = int(datetime.now().timestamp())
+            history = [
+                {
+                    'id': ref_ids[note.id],
+                    'text': note.title,
+                    'time': now,
+                    'tags': tags.get(note.id, []),
+                }
+                for note in notes
+            ]
         resp = self.POST(
             'history',
             content=urlencode({'history': json.dumps(history)}),
             content_type='application/x-www-form-urlencoded',
         )
         resp.raise_for_status()
+        self.history_stale = False
 
 
-hedgedoc = Hedgedoc()
+hedgedoc: Hedgedoc = Lazy(Hedgedoc, 'hedgedoc')  # type: ignore
@@ -1,14 +1,19 @@
 import csv
+import json
 import re
+import threading
 import typing as t
+from collections import OrderedDict
 from enum import StrEnum
 from itertools import chain
 
 import yaml
-from sqlalchemy import (UUID, Column, Enum, ForeignKey, Integer, String, Text,
-                        Time)
+from sqlalchemy import (UUID, Column, DateTime, Enum, ForeignKey, Integer,
+                        String, Text)
 from sqlalchemy.orm import DeclarativeBase, declarative_base, relationship
 
+from utils import count, hash_content, timed
+
 Base: type[DeclarativeBase] = declarative_base()
 T_Base = t.TypeVar('T_Base', bound=DeclarativeBase)
 
@@ -30,17 +35,17 @@ class Note(Base):
     alias = Column('alias', String(length=255))
     _title = Column('title', Text)
     content = Column('content', Text)
-    created_at = Column('createdAt', Time)
-    updated_at = Column('updatedAt', Time)
-    deleted_at = Column('deletedAt', Time)
-    # save_at = Column('saveAt', Time)
+    created_at = Column('createdAt', DateTime(timezone=True))
+    updated_at = Column('updatedAt', DateTime(timezone=True))
+    deleted_at = Column('deletedAt', DateTime(timezone=True))
+    # save_at = Column('saveAt', DateTime(timezone=True))
 
     view_count = Column('viewcount', Integer)
 
     owner_id = Column('ownerId', UUID)
     permission = Column('permission', Enum(NotePermissionEnum, name='enum_Notes_permission'), default='editable')
     last_change_user_id = Column('lastchangeuserId', ForeignKey('Users.id'))
-    last_change_at = Column('lastchangeAt', Time)
+    last_change_at = Column('lastchangeAt', DateTime(timezone=True))
     # authorship = Column('authorship', Text)
 
     owner = relationship('User', back_populates='notes', cascade='all')
@@ -53,70 +58,142 @@ class Note(Base):
 
     @property
     def tags(self) -> list[str]:
-        return Note.get_tags(self.content)  # type: ignore
+        return list(self.parsed.tags)
+
+    @property
+    def parsed(self) -> 'NoteMeta':
+        """Return the metadata parsed from the content, memoized until the content changes."""
+        content = self.content or ''
+        cached = getattr(self, '_parsed', None)
+        if cached is None or cached[0] is not content:
+            cached = self._parsed = (content, Note.parse(content))
+        return cached[1]
 
     @staticmethod
     def get_alias(*, title: str = '', tags: list[str] = [], content: str = '') -> str:
         """Generate a unique alias for a note."""
         def sanitized(part: str) -> str:
             # include the chinese charsets
-            sanitized = re.sub(r'[^a-zA-Z0-9\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+', '-', part.strip()).lower()
+            sanitized = _ALIAS_INVALID_CHARS.sub('-', part.strip()).lower()
             return sanitized.replace('--', '-')
 
-        tags = tags or Note.get_tags(content)
-        title = title or Note.get_title(content)
+        if not tags or not title:
+            parsed = Note.parse(content)
+            tags = tags or list(parsed.tags)
+            title = title or parsed.title
         return '--'.join(sanitized(t) for t in [*tags, title])
 
     @staticmethod
     def get_title(content: str) -> str:
         """Extract title from a markdown content."""
-        if title := Note.get_meta(content).get('title'):
-            return title.strip()  # type: ignore
-
-        prev = ''
-        template = r'^ *=+$'
-        for line in content.split('\n'):
-            if re.findall(template, line) and prev:
-                return prev.strip()  # type: ignore
-            prev = line
-        return 'Untitled'
+        return Note.parse(content).title
 
     @staticmethod
     def get_tags(content: str) -> list[str]:
         """Extract tags from a Markdown content."""
-        if tags := Note.get_meta(content).get('tags'):
-            return (
-                [tag.strip() for tag in tags]
-                if isinstance(tags, list)
-                else [tag.strip() for tag in chain(*csv.reader([tags]))]
-            )
-
-        tags = []
-        template = r'`([^`]*)`'
-        for line in content.split('\n'):
-            if raw_tags := line.partition('###### tags')[-1]:
-                tags += [tag for tag in re.findall(template, raw_tags) if tag]
-        return [tag.strip() for tag in dict.fromkeys(tags)]
+        return list(Note.parse(content).tags)
 
     @staticmethod
     def get_meta(content: str) -> dict[str, str | list[str]]:
         """Extract YAML metadata from a Markdown content."""
-        if not content.startswith('---'):
-            return {}
+        return dict(Note.parse(content).meta)
+
+    @staticmethod
+    def parse(content: str) -> 'NoteMeta':
+        """Extract title, tags and YAML metadata from a Markdown content at once."""
+        digest = hash_content(content)
+        with _parsed_notes_lock:
+            if (parsed := _parsed_notes.get(digest)) is not None:
+                _parsed_notes.move_to_end(digest)
+                return parsed
 
-        raw_meta = ''
-        for line in content.split('\n')[1:]:
-            if not line:
-                continue
-            if line.startswith('---'):
-                break
-            raw_meta += line + '\n'
+        parsed = _parse(content)
+        count('notes parsed')
+        with _parsed_notes_lock:
+            _parsed_notes[digest] = parsed
+            if len(_parsed_notes) > _PARSED_NOTES_MAXSIZE:
+                _parsed_notes.popitem(last=False)
+        return parsed
 
-        try:
-            meta = yaml.safe_load(raw_meta)
-        except yaml.YAMLError:
-            return {}
-        return meta if isinstance(meta, dict) else {}
+
+class NoteMeta(t.NamedTuple):
+    title: str
+    tags: tuple[str, ...]
+    meta: dict[str, t.Any]
+
+
+_ALIAS_INVALID_CHARS = re.compile(r'[^a-zA-Z0-9\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+')
+_META_END = re.compile(r'^---', re.MULTILINE)
+_SETEXT_TITLE = re.compile(r'^(.+)\n *=+$', re.MULTILINE)
+_TAGS_LINE = re.compile(r'###### tags(.*)')
+_TAG = re.compile(r'`([^`]*)`')
+# `key: value` lines with plain string values to YAML, i.e. no quotes, comments, flow collections, numbers, etc.
+_SIMPLE_META_LINE = re.compile(r'([A-Za-z_][A-Za-z0-9_-]*): +([^\W\d_][\w ,./-]*)')
+_YAML_KEYWORDS = {'true', 'false', 'yes', 'no', 'on', 'off', 'null'}
+
+_PARSED_NOTES_MAXSIZE = 4096
+_parsed_notes: OrderedDict[str, NoteMeta] = OrderedDict()  # LRU cache keyed by utils.hash_content
+_parsed_notes_lock = threading.Lock()
+
+
+def _parse(content: str) -> NoteMeta:
+    meta = _parse_meta(content)
+
+    if title := meta.get('title'):
+        title = str(title).strip()
+    elif match := _SETEXT_TITLE.search(content):
+        title = match[1].strip()
+    else:
+        title = 'Untitled'
+
+    if tags := meta.get('tags'):
+        tags = (
+            [str(tag).strip() for tag in tags]
+            if isinstance(tags, list)
+            else [tag.strip() for tag in chain(*csv.reader([str(tags)]))]
+        )
+    else:
+        tags = []
+        for match in _TAGS_LINE.finditer(content):
+            tags += [tag for tag in _TAG.findall(match[1]) if tag]
+        tags = [tag.strip() for tag in dict.fromkeys(tags)]
+
+    return NoteMeta(title, tuple(tags), meta)
+
+
+def _parse_meta(content: str) -> dict[str, t.Any]:
+    """Extract YAML metadata between the leading `---` line and the next one."""
+    if not content.startswith('---'):
+        return {}
+
+    start = content.find('\n') + 1
+    if not start:
+        return {}
+    end = match.start() if (match := _META_END.search(content, start)) else len(content)
+    if not (lines := [line for line in content[start:end].split('\n') if line]):
+        return {}
+
+    if (meta := _parse_simple_meta(lines)) is not None:
+        return meta
+    try:
+        with timed('parse yaml'):
+            meta = yaml.safe_load(''.join(line + '\n' for line in lines))
+    except yaml.YAMLError:
+        return {}
+    return meta if isinstance(meta, dict) else {}
+
+
+def _parse_simple_meta(lines: list[str]) -> dict[str, str] | None:
+    """Parse metadata made of `key: value` lines only without PyYAML, or return None if it is not the case."""
+    meta = {}
+    for line in lines:
+        if not (match := _SIMPLE_META_LINE.fullmatch(line.rstrip(' '))):
+            return None
+        key, value = match.groups()
+        if key.lower() in _YAML_KEYWORDS or value.lower() in _YAML_KEYWORDS:
+            return None
+        meta[key] = value
+    return meta
 
 
 class User(Base):
@@ -128,8 +205,8 @@ class User(Base):
     email = Column('email', Text)
     password = Column('password', Text)
     history = Column('history', Text)
-    created_at = Column('createdAt', Time)
-    updated_at = Column('updatedAt', Time)
+    created_at = Column('createdAt', DateTime(timezone=True))
+    updated_at = Column('updatedAt', DateTime(timezone=True))
 
     access_token = Column('accessToken', Text)
     refresh_token = Column('refreshToken', Text)
@@ -138,6 +215,16 @@ class User(Base):
     notes = relationship('Note', back_populates='owner', cascade='all, delete-orphan')
     authors = relationship('Author', back_populates='user', cascade='all, delete-orphan')
 
+    @property
+    def name(self) -> str:
+        """Return the display name of the user, from the profile of the OAuth users or else the email."""
+        try:
+            profile = json.loads(self.profile or '{}')  # type: ignore
+        except ValueError:
+            profile = {}
+        name = profile.get('displayName') or profile.get('username') or (self.email or '').split('@')[0]
+        return name or str(self.id)
+
 
 class Author(Base):
     __tablename__ = 'Authors'
@@ -146,13 +233,27 @@ class Author(Base):
     color = Column('color', String(length=255))
     note_id = Column('noteId', UUID, ForeignKey('Notes.id'))
     user_id = Column('userId', UUID, ForeignKey('Users.id'))
-    created_at = Column('createdAt', Time)
-    updated_at = Column('updatedAt', Time)
+    created_at = Column('createdAt', DateTime(timezone=True))
+    updated_at = Column('updatedAt', DateTime(timezone=True))
 
     note = relationship('Note', back_populates='authors', cascade='all')
     user = relationship('User', back_populates='authors', cascade='all')
 
-# class Revision(Base): ...
+
+class Revision(Base):
+    __tablename__ = 'Revisions'
+
+    id = Column('id', UUID, primary_key=True)
+    note_id = Column('noteId', UUID, ForeignKey('Notes.id'))
+    patch = Column('patch', Text)  # a diff-match-patch patch from the previous revision
+    last_content = Column('lastContent', Text)  # the content of the first revision of a note
+    content = Column('content', Text)  # the content of the latest revision of a note only
+    length = Column('length', Integer)
+    authorship = Column('authorship', Text)  # JSON of [[userId, start, end, createdAt, updatedAt], ...]
+    created_at = Column('createdAt', DateTime(timezone=True))
+    updated_at = Column('updatedAt', DateTime(timezone=True))
+
+
 # class SequelizedMeta(Base): ...
 # class Session(Base): ...
 # class Temp(Base): ...
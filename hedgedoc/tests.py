@@ -1,6 +1,15 @@
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+import httpx
 import pytest
+import yaml
+
+from configs import configs
 
-from .models import Note
+from .core import Hedgedoc, HedgedocStore
+from .models import Base, Note, User, _parse_simple_meta
 
 
 @pytest.mark.parametrize(
@@ -35,3 +44,83 @@ from .models import Note
 )
 def test_get_tags(content, expected_tags) -> None:
     assert Note.get_tags(content) == expected_tags
+
+
+@pytest.mark.parametrize(
+    'content, expected_title, expected_tags',
+    (
+        ('---\ntitle: TITLE\ntags: tag1, tag2\n---\n', 'TITLE', ['tag1', 'tag2']),
+        ('---\ntitle: TITLE\ntags:\n  - tag1\n  - tag2\n---\n', 'TITLE', ['tag1', 'tag2']),
+        ('---\ntags: tag1\n---\n\nTITLE\n===\n###### tags: `tag2`', 'TITLE', ['tag1']),
+        ('Intro\n\nTITLE\n=====\n\n###### tags: `tag1` `tag2`', 'TITLE', ['tag1', 'tag2']),
+        ('no title', 'Untitled', []),
+    ),
+)
+def test_parse(content, expected_title, expected_tags) -> None:
+    parsed = Note.parse(content)
+    assert (parsed.title, list(parsed.tags)) == (expected_title, expected_tags)
+    assert (Note.get_title(content), Note.get_tags(content)) == (expected_title, expected_tags)
+    assert Note.parse(content) is parsed
+
+
+@pytest.mark.parametrize(
+    'line',
+    (
+        'tags: tag1, tag2',
+        'title: Title with spaces  ',
+        'title: 中文, ascii-mixed_v1.0/x',
+        'title: yes',
+        'title: 2023-01-01',
+        'title: quoted: colon',
+        "title: 'quoted'",
+        'title: comment # here',
+        'tags: [tag1, tag2]',
+    ),
+)
+def test_parse_simple_meta(line) -> None:
+    if (meta := _parse_simple_meta([line])) is not None:
+        assert meta == yaml.safe_load(line)
+
+
+@pytest.mark.parametrize(
+    'profile, email, expected_name',
+    (
+        ('{"displayName": "Alice", "username": "alice"}', None, 'Alice'),
+        ('{"username": "alice"}', 'a@example.com', 'alice'),
+        (None, 'bob@example.com', 'bob'),
+        ('not json', None, '00000000-0000-0000-0000-000000000000'),
+    ),
+)
+def test_user_name(profile, email, expected_name) -> None:
+    user = User(id='00000000-0000-0000-0000-000000000000', profile=profile, email=email)
+    assert user.name == expected_name
+
+
+def test_get_taken_aliases(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setitem(configs, 'DB_URL', f'sqlite:///{tmp_path / "db.sqlite"}')
+    hedgedoc = Hedgedoc.__new__(Hedgedoc)  # the database only
+    HedgedocStore.__init__(hedgedoc)
+    Base.metadata.create_all(hedgedoc.session.bind)  # type: ignore
+    now = datetime.now()
+    hedgedoc.session.add_all([
+        Note(id=uuid.uuid4(), short_id='a', alias='alias-a', created_at=now, updated_at=now),
+        Note(id=uuid.uuid4(), short_id='b', alias=None, created_at=now, updated_at=now),
+    ])
+    hedgedoc.session.commit()
+    assert hedgedoc.get_taken_aliases({'alias-a', 'a', 'b', 'c'}) == {'alias-a', 'a', 'b'}
+
+
+def test_get_uploads_skips_failures(monkeypatch: pytest.MonkeyPatch) -> None:
+    def handle(request: httpx.Request) -> httpx.Response:
+        if request.url.path == '/uploads/slow.png':
+            raise httpx.ReadTimeout('timed out', request=request)
+        if request.url.path == '/uploads/gone.png':
+            return httpx.Response(404)
+        return httpx.Response(200, content=b'png')
+
+    monkeypatch.setitem(configs, 'HTTP_RETRIES', 0)
+    hedgedoc = Hedgedoc.__new__(Hedgedoc)  # the API only, without logging in
+    hedgedoc.server = httpx.URL('http://hedgedoc.test/')
+    hedgedoc.client = httpx.Client(transport=httpx.MockTransport(handle))
+    uploads = dict(hedgedoc.get_uploads(['slow.png', 'gone.png', 'ok.png']))
+    assert uploads == {'slow.png': None, 'gone.png': None, 'ok.png': b'png'}
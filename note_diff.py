@@ -0,0 +1,256 @@
+import heapq
+import json
+import os
+import tempfile
+import typing as t
+from collections import defaultdict
+from enum import StrEnum
+from itertools import batched, chain, groupby, islice
+from pathlib import Path
+
+from configs import configs
+from utils import hash_content
+
+EMPTY_HASH = hash_content('')
+
+
+class NoteRecord(t.NamedTuple):
+    """The identity and content hash of a note, without its content or ORM state (a plain tuple, no __dict__)."""
+    path: str  # relative to the repository
+    hash: str  # see utils.hash_content
+    id: str = ''  # Note.id, or empty if unknown (e.g. a file not pushed from Hedgedoc)
+    alias: str = ''
+    tags: tuple[str, ...] = ()
+
+
+class ChangeType(StrEnum):
+    added = 'added'
+    removed = 'removed'
+    modified = 'modified'
+    renamed = 'renamed'  # moved to another path, possibly modified as well
+    unchanged = 'unchanged'
+
+
+class Change(t.NamedTuple):
+    type: ChangeType
+    source: NoteRecord | None  # None for the removed notes
+    target: NoteRecord | None  # None for the added notes
+
+    @property
+    def content_changed(self) -> bool:
+        return self.source is None or self.target is None or self.source.hash != self.target.hash
+
+
+def get_keys(note: NoteRecord) -> tuple[str, str, str, str]:
+    """Return the keys a note is matched by, in the order of precedence."""
+    # an empty note tells nothing about its identity
+    return note.id, note.alias, note.path, note.hash if note.hash != EMPTY_HASH else ''
+
+
+def is_compatible(source: NoteRecord, target: NoteRecord) -> bool:
+    # notes with different ids are never the same, whatever else they share
+    return not (source.id and target.id and source.id != target.id)
+
+
+def classify(source: NoteRecord, target: NoteRecord) -> Change:
+    if target.path != source.path:
+        return Change(ChangeType.renamed, source, target)
+    if target.hash != source.hash:
+        return Change(ChangeType.modified, source, target)
+    return Change(ChangeType.unchanged, source, target)
+
+
+class NoteDiff:
+    """A hash join of the notes being synced from (the sources) against the notes being synced to (the targets).
+
+    The targets are indexed by id, alias, path and content hash, in the order of precedence. Each source probes
+    the indexes in that order and is matched with the first target not matched yet, so a note keeps its identity
+    when retagged or retitled, and a note without one is still found by its path or, failing that, its content.
+    """
+
+    def __init__(self, targets: t.Iterable[NoteRecord]) -> None:
+        self.targets = list(targets)
+        self.matched = [False] * len(self.targets)
+        self.indexes: tuple[dict[str, list[int]], ...] = tuple(defaultdict(list) for _ in range(4))
+        for i, target in enumerate(self.targets):
+            for index, key in zip(self.indexes, get_keys(target)):
+                if key:
+                    index[key].append(i)
+
+    def find(self, source: NoteRecord, *, fuzzy: bool = True) -> int | None:
+        for index, key in zip(self.indexes if fuzzy else self.indexes[:2], get_keys(source)):
+            for i in index.get(key, ()) if key else ():
+                if not self.matched[i] and is_compatible(source, self.targets[i]):
+                    return i
+        return None
+
+    def match(self, source: NoteRecord, *, fuzzy: bool = True) -> Change | None:
+        """Match a note with a target and classify the change, or return None if not `fuzzy` and nothing matches.
+
+        Only the id and alias are probed unless `fuzzy`.
+        """
+        i = self.find(source, fuzzy=fuzzy)
+        if i is None:
+            return Change(ChangeType.added, source, None) if fuzzy else None
+
+        self.matched[i] = True
+        return classify(source, self.targets[i])
+
+    def removed(self) -> list[Change]:
+        """Return the targets not matched so far."""
+        return [
+            Change(ChangeType.removed, None, target)
+            for target, matched in zip(self.targets, self.matched)
+            if not matched
+        ]
+
+
+def diff_notes(sources: t.Iterable[NoteRecord], targets: t.Iterable[NoteRecord], *,
+               spill_threshold: int | None = None) -> t.Iterator[Change]:
+    """Classify every note on either side.
+
+    The notes with a known identity are matched first, so that a note matched by its path or content cannot take
+    the target of another note with the same id or alias. Up to `spill_threshold` notes on each side
+    (DIFF_SPILL_THRESHOLD by default) are hash-joined in memory; beyond that, both sides are spilled to disk and
+    joined by sorted-run merges.
+    """
+    if spill_threshold is None:
+        spill_threshold = configs['DIFF_SPILL_THRESHOLD']
+    sources, targets = iter(sources), iter(targets)
+    source_head = list(islice(sources, spill_threshold + 1))
+    target_head = list(islice(targets, spill_threshold + 1))
+    if len(source_head) > spill_threshold or len(target_head) > spill_threshold:
+        yield from merge_notes(chain(source_head, sources), chain(target_head, targets), max(spill_threshold, 1))
+        return
+
+    diff = NoteDiff(target_head)
+    unmatched = []
+    for source in source_head:
+        if (change := diff.match(source, fuzzy=False)) is None:
+            unmatched.append(source)
+        else:
+            yield change
+    for source in unmatched:
+        yield diff.match(source)  # type: ignore
+    yield from diff.removed()
+
+
+class RunFile:
+    """A file of note records spilled to disk, one JSON array per line."""
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.file: t.TextIO | None = None
+
+    def __enter__(self) -> 'RunFile':
+        self.file = self.path.open('w', encoding='utf-8')
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.file.close()  # type: ignore
+
+    def write(self, note: NoteRecord) -> None:
+        self.file.write(json.dumps(note, ensure_ascii=False) + '\n')  # type: ignore
+
+    def __iter__(self) -> t.Iterator[NoteRecord]:
+        with self.path.open(encoding='utf-8') as f:
+            for line in f:
+                path, digest, note_id, alias, tags = json.loads(line)
+                yield NoteRecord(path, digest, note_id, alias, tuple(tags))
+
+
+def sort_notes(notes: t.Iterable[NoteRecord], key: t.Callable[[NoteRecord], str], run_size: int,
+               tmp_dir: Path) -> t.Iterator[NoteRecord]:
+    """Sort the notes in runs of `run_size` spilled to disk, and merge the runs lazily."""
+    runs = []
+    for chunk in batched(notes, run_size):
+        fd, name = tempfile.mkstemp(dir=tmp_dir)
+        os.close(fd)  # reopened by RunFile
+        with RunFile(Path(name)) as run:
+            for note in sorted(chunk, key=key):
+                run.write(note)
+        runs.append(run)
+    return heapq.merge(*runs, key=key)
+
+
+def merge_notes(sources: t.Iterable[NoteRecord], targets: t.Iterable[NoteRecord],
+                run_size: int) -> t.Iterator[Change]:
+    """Join the notes by sorted-run merges per key, holding at most `run_size` notes per side and run in memory.
+
+    The notes left unmatched by a key are spilled to disk and merged by the next, as NoteDiff probes its indexes.
+    """
+    configs['CACHE_DIR'].mkdir(parents=True, exist_ok=True)  # rather than a /tmp possibly backed by memory
+    with tempfile.TemporaryDirectory(prefix='diff-', dir=configs['CACHE_DIR']) as tmp:
+        tmp_dir = Path(tmp)
+        for i in range(4):  # see get_keys
+            def key(note: NoteRecord) -> str:
+                return get_keys(note)[i]
+
+            def split(notes: t.Iterable[NoteRecord], unmatched: RunFile) -> t.Iterator[NoteRecord]:
+                # the notes without the key skip the merge
+                for note in notes:
+                    if key(note):
+                        yield note
+                    else:
+                        unmatched.write(note)
+
+            with (
+                RunFile(tmp_dir / f'sources-{i}') as sources_left,
+                RunFile(tmp_dir / f'targets-{i}') as targets_left,
+            ):
+                sorted_sources = sort_notes(split(sources, sources_left), key, run_size, tmp_dir)
+                sorted_targets = sort_notes(split(targets, targets_left), key, run_size, tmp_dir)
+                notes = heapq.merge(
+                    ((key(note), 0, note) for note in sorted_sources),
+                    ((key(note), 1, note) for note in sorted_targets),
+                    key=lambda item: item[:2],
+                )
+                for _, group in groupby(notes, key=lambda item: item[0]):
+                    group_sources, group_targets = [], []
+                    for _, side, note in group:
+                        (group_targets if side else group_sources).append(note)
+                    for source in group_sources:
+                        if (target := next((c for c in group_targets if is_compatible(source, c)), None)) is None:
+                            sources_left.write(source)
+                        else:
+                            group_targets.remove(target)
+                            yield classify(source, target)
+                    for target in group_targets:
+                        targets_left.write(target)
+            sources, targets = sources_left, targets_left
+
+        yield from (Change(ChangeType.added, source, None) for source in sources)
+        yield from (Change(ChangeType.removed, None, target) for target in targets)
+
+
+class Resolution(StrEnum):
+    unchanged = 'unchanged'  # in sync, or changed the same way on both sides
+    pushed = 'pushed'  # changed in Hedgedoc only, i.e. to be synced to git
+    pulled = 'pulled'  # changed in git only, i.e. to be synced to Hedgedoc
+    conflict = 'conflict'  # changed differently on both sides
+
+
+def resolve(change: Change, base: NoteRecord | None) -> Resolution:
+    """Decide the way a change of a note in git (the source) against Hedgedoc (the target) is synced.
+
+    The base is the note as of the last sync, if any. Without a base, a note on one side only is new there, and a
+    note with different contents on both sides is a conflict. A note with the same content on both sides takes the
+    path in Hedgedoc, i.e. of its tags and title, unless it was moved in git.
+    """
+    source, target = change.source, change.target
+    if source is not None and target is not None and source.hash == target.hash:
+        if source.path == target.path:
+            return Resolution.unchanged
+        return Resolution.pulled if base is not None and target.path == base.path else Resolution.pushed
+    if base is None:
+        if source is not None and target is not None:
+            return Resolution.conflict
+        return Resolution.pulled if source is not None else Resolution.pushed
+
+    source_changed = source is None or (source.path, source.hash) != (base.path, base.hash)
+    target_changed = target is None or (target.path, target.hash) != (base.path, base.hash)
+    if source_changed and target_changed:
+        return Resolution.conflict
+    if source_changed:
+        return Resolution.pulled
+    return Resolution.pushed if target_changed else Resolution.unchanged
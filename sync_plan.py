@@ -0,0 +1,96 @@
+import json
+import typing as t
+from pathlib import Path
+
+from git_helper import IndexEntry
+from sync_state import NoteState
+from utils import exit_with_error
+
+PLAN_VERSION = 1
+ACTIONS = ('pull', 'push')
+
+
+class AliasChange(t.TypedDict):
+    id: str  # Note.id
+    alias: str | None  # the current alias
+    new_alias: str
+
+
+class FileWrite(t.TypedDict):
+    path: str  # relative to the repository
+    hash: str  # of the content of the note, see utils.hash_content
+    base: str | None  # the hash of the file overwritten, or None for a new file
+    entry: IndexEntry
+
+
+class FileRemove(t.TypedDict):
+    path: str
+    base: str
+
+
+class NoteCreate(t.TypedDict):
+    path: str
+    hash: str  # of the file the note is created from
+
+
+class NoteUpdate(t.TypedDict):
+    id: str
+    path: str
+    hash: str  # of the file the note is updated from
+    base: str  # the hash of the content overwritten
+
+
+class NoteDelete(t.TypedDict):
+    id: str
+    path: str  # the file the note was pushed to
+    base: str
+
+
+class SyncPlan:
+    """The changes a pull or push is to make, computed by --plan and executed later by --apply.
+
+    Each change records the content hashes it was computed from, i.e. of the files and notes it overwrites, so
+    that applying the plan checks only those for staleness rather than comparing every note again.
+    """
+
+    def __init__(self, action: str, owner: str, *, overwrite: bool, comment: str | None = None,
+                 commit: str | None = None) -> None:
+        self.action = action  # 'pull' or 'push'
+        self.owner = owner  # the user id the notes belong to
+        self.overwrite = overwrite
+        self.comment = comment  # the message of the commit pushed
+        self.commit = commit  # the commit the plan was computed against
+        self.aliases: list[AliasChange] = []
+        # pushing
+        self.writes: list[FileWrite] = []
+        self.removes: list[FileRemove] = []
+        self.uploads: list[str] = []  # the names of the uploaded files to be stored
+        self.watermark: str | None = None  # of the sync state once pushed
+        self.notes: dict[str, NoteState | None] = {}  # the entries of the sync state changed, or None if dropped
+        # pulling
+        self.creates: list[NoteCreate] = []
+        self.updates: list[NoteUpdate] = []
+        self.deletes: list[NoteDelete] = []
+
+    @classmethod
+    def load(cls, path: Path) -> 'SyncPlan':
+        try:
+            data = json.loads(path.read_text(encoding='utf-8'))
+        except (OSError, ValueError) as e:
+            exit_with_error(f'Cannot read the plan {path}: {e}')
+        if not isinstance(data, dict) or data.get('version') != PLAN_VERSION or data.get('action') not in ACTIONS:
+            exit_with_error(f'Unsupported plan: {path}')
+
+        plan = cls(
+            data['action'], data['owner'],
+            overwrite=data['overwrite'], comment=data.get('comment'), commit=data.get('commit'),
+        )
+        keys = ('aliases', 'writes', 'removes', 'uploads', 'watermark', 'notes', 'creates', 'updates', 'deletes')
+        for key in keys:
+            setattr(plan, key, data.get(key, getattr(plan, key)))
+        return plan
+
+    def save(self, path: Path) -> None:
+        tmp_path = path.with_name(f'{path.name}.tmp')
+        tmp_path.write_text(json.dumps({'version': PLAN_VERSION, **vars(self)}, indent=2), encoding='utf-8')
+        tmp_path.replace(path)
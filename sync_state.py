@@ -0,0 +1,83 @@
+import json
+import typing as t
+from datetime import datetime
+from pathlib import Path
+
+from configs import configs
+
+
+class NoteState(t.TypedDict):
+    path: str  # relative to the repository
+    tags: list[str]
+    hash: str  # see utils.hash_content
+    updated_at: str  # ISO 8601
+
+
+class SyncState:
+    """The notes written to the Git repository by the last successful push.
+
+    The entry of a note stays valid until the note is updated again, which saves loading its content.
+    The watermark is only valid if the repository is still at the commit pushed along with the state.
+    """
+
+    def __init__(self, owner: str, commit: str | None = None, watermark: datetime | None = None,
+                 notes: dict[str, NoteState] | None = None, *, prefix: str = '') -> None:
+        self.owner = owner  # the user id the notes belong to
+        self.prefix = prefix  # the directory the notes are written under, see _helpers.push_users
+        self.commit = commit  # the commit the state is in sync with
+        self.watermark = watermark  # the latest Note.updated_at seen
+        self.notes = notes or {}  # keyed by Note.id
+
+    @staticmethod
+    def get_path(owner: str, prefix: str = '') -> Path:
+        # the users synced at once are kept apart
+        return configs['CACHE_DIR'] / (f'states/{owner}.json' if prefix else 'state.json')
+
+    @classmethod
+    def load(cls, owner: str, prefix: str = '') -> 'SyncState':
+        """Return the persisted state, or an empty one (i.e. a full sync) if there is none for the user."""
+        try:
+            state = json.loads(cls.get_path(owner, prefix).read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            return cls(owner, prefix=prefix)
+
+        if state.get('owner') != owner or state.get('prefix', '') != prefix:
+            return cls(owner, prefix=prefix)
+        return cls(
+            owner,
+            commit=state['commit'],
+            watermark=datetime.fromisoformat(state['watermark']) if state.get('watermark') else None,
+            notes=state['notes'],
+            prefix=prefix,
+        )
+
+    def get(self, note_id: str, updated_at: datetime | None) -> NoteState | None:
+        """Return the entry of a note unless it has been updated since."""
+        note = self.notes.get(note_id)
+        if note is None or not updated_at or note['updated_at'] != updated_at.isoformat():
+            return None
+        return note
+
+    def update(self, note_id: str, path: str, tags: list[str], digest: str, updated_at: datetime | None) -> None:
+        self.notes[note_id] = {
+            'path': path,
+            'tags': tags,
+            'hash': digest,
+            'updated_at': updated_at.isoformat() if updated_at else '',
+        }
+        if updated_at and (self.watermark is None or updated_at > self.watermark):
+            self.watermark = updated_at
+
+    def save(self, commit: str | None) -> None:
+        self.commit = commit
+        path = self.get_path(self.owner, self.prefix)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps({
+            'owner': self.owner,
+            'prefix': self.prefix,
+            'commit': self.commit,
+            'watermark': self.watermark.isoformat() if self.watermark else None,
+            'notes': self.notes,
+        }), encoding='utf-8')
+        tmp_path.replace(path)  # atomic, so that a killed run never leaves a half-written state
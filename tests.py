@@ -0,0 +1,334 @@
+import tarfile
+import threading
+import typing as t
+import uuid
+import zipfile
+from datetime import datetime
+from pathlib import Path
+from types import SimpleNamespace
+
+import git
+
+import pytest
+
+import _helpers
+import utils
+from archive import open_archive
+from configs import configs
+from git_helper import MANIFEST_PATH, NoteIndex, UploadManifest
+from note_diff import EMPTY_HASH, Change, ChangeType, NoteRecord, Resolution, diff_notes, resolve
+from sync_plan import SyncPlan
+from utils import hash_content
+
+
+@pytest.mark.parametrize(
+    'sources, targets, expected_types',
+    (
+        (  # matched by id despite a new path and content
+            [NoteRecord('b/A.md', '2', 'id-a')],
+            [NoteRecord('a/A.md', '1', 'id-a')],
+            [ChangeType.renamed],
+        ),
+        (  # matched by path without a known identity
+            [NoteRecord('a/A.md', '2')],
+            [NoteRecord('a/A.md', '1', 'id-a', 'a--a')],
+            [ChangeType.modified],
+        ),
+        (  # matched by content without a known identity
+            [NoteRecord('b/A.md', '1')],
+            [NoteRecord('a/A.md', '1', 'id-a')],
+            [ChangeType.renamed],
+        ),
+        (  # notes with different ids are never matched
+            [NoteRecord('a/A.md', '1', 'id-b')],
+            [NoteRecord('a/A.md', '1', 'id-a')],
+            [ChangeType.added, ChangeType.removed],
+        ),
+        (  # empty notes are not matched by content
+            [NoteRecord('b/A.md', EMPTY_HASH)],
+            [NoteRecord('a/A.md', EMPTY_HASH)],
+            [ChangeType.added, ChangeType.removed],
+        ),
+        (  # swapped paths
+            [NoteRecord('a/A.md', '2', 'id-b'), NoteRecord('b/B.md', '1', 'id-a')],
+            [NoteRecord('a/A.md', '1', 'id-a'), NoteRecord('b/B.md', '2', 'id-b')],
+            [ChangeType.renamed, ChangeType.renamed],
+        ),
+    ),
+)
+@pytest.mark.parametrize('spill_threshold', (100, 0))  # in memory, or spilled in runs of a single note
+def test_diff_notes(
+    sources: list[NoteRecord], targets: list[NoteRecord], expected_types: list[ChangeType], spill_threshold: int,
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch,
+):
+    monkeypatch.setitem(configs, 'CACHE_DIR', tmp_path)
+    changes = diff_notes(sources, targets, spill_threshold=spill_threshold)
+    assert [change.type for change in changes] == expected_types
+
+
+@pytest.mark.parametrize('spill_threshold', (100, 0))
+def test_diff_notes_prefers_identity(spill_threshold: int, tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setitem(configs, 'CACHE_DIR', tmp_path)
+    # the note without a known identity must not take the target of the note with the same id
+    sources = [NoteRecord('a/A.md', '1'), NoteRecord('b/A.md', '1', 'id-a')]
+    targets = [NoteRecord('a/A.md', '1', 'id-a')]
+    changes = {
+        change.source: change
+        for change in diff_notes(sources, targets, spill_threshold=spill_threshold)
+        if change.source
+    }
+    assert changes[sources[0]].type == ChangeType.added
+    assert changes[sources[1]].type == ChangeType.renamed
+
+
+@pytest.mark.skipif(not Path('/proc/self/fd').is_dir(), reason='lists the open file descriptors from /proc')
+def test_diff_notes_closes_runs(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setitem(configs, 'CACHE_DIR', tmp_path)
+    notes = [NoteRecord(f'{i}.md', str(i)) for i in range(200)]
+    open_fds = len(list(Path('/proc/self/fd').iterdir()))
+    assert all(change.type == ChangeType.unchanged for change in diff_notes(notes, notes, spill_threshold=10))
+    assert len(list(Path('/proc/self/fd').iterdir())) == open_fds
+
+
+@pytest.mark.parametrize('name', ('notes.zip', 'notes.tar.gz', 'notes.tar'))
+def test_archive(name: str, tmp_path: Path):
+    path = tmp_path / name
+    with open_archive(path) as archive:
+        archive.add('a/A.md', 'Ä\n', datetime(2024, 1, 1))
+        archive.add('B.md', '', datetime(2024, 1, 2))
+    if name.endswith('.zip'):
+        with zipfile.ZipFile(path) as f:
+            files = {name: f.read(name) for name in f.namelist()}
+    else:
+        with tarfile.open(path) as f:
+            files = {member.name: f.extractfile(member).read() for member in f}  # type: ignore
+    assert files == {'a/A.md': 'Ä\n'.encode(), 'B.md': b''}
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_archive_removed_on_error(tmp_path: Path):
+    with pytest.raises(RuntimeError), open_archive(tmp_path / 'notes.zip') as archive:
+        archive.add('A.md', 'A', datetime(2024, 1, 1))
+        raise RuntimeError
+    assert not list(tmp_path.iterdir())
+
+
+def test_upload_manifest_dedupes():
+    manifest = UploadManifest(path='users/a/' + MANIFEST_PATH)
+    rel_path = manifest.add('upload_a.png', b'PNG')
+    assert rel_path.startswith('users/a/') and rel_path.endswith('.png')
+    assert manifest.add('upload_b.png', b'PNG') == rel_path  # the same file uploaded twice is stored once
+    assert manifest.get('upload_b.png') == rel_path
+    assert manifest.get('upload_c.png') is None
+
+
+BASE = NoteRecord('A.md', 'h0', 'a')
+
+
+@pytest.mark.parametrize('source, target, base, resolution', (
+    (NoteRecord('A.md', 'h0', 'a'), NoteRecord('A.md', 'h0', 'a'), BASE, Resolution.unchanged),
+    (NoteRecord('A.md', 'h1', 'a'), NoteRecord('A.md', 'h0', 'a'), BASE, Resolution.pulled),
+    (NoteRecord('A.md', 'h0', 'a'), NoteRecord('A.md', 'h1', 'a'), BASE, Resolution.pushed),
+    (NoteRecord('A.md', 'h1', 'a'), NoteRecord('A.md', 'h2', 'a'), BASE, Resolution.conflict),
+    (NoteRecord('A.md', 'h1', 'a'), NoteRecord('A.md', 'h1', 'a'), BASE, Resolution.unchanged),  # the same edit
+    (None, NoteRecord('A.md', 'h0', 'a'), BASE, Resolution.pulled),  # removed from git
+    (NoteRecord('A.md', 'h0', 'a'), None, BASE, Resolution.pushed),  # deleted in Hedgedoc
+    (None, NoteRecord('A.md', 'h1', 'a'), BASE, Resolution.conflict),
+    (NoteRecord('B.md', 'h0', 'a'), NoteRecord('A.md', 'h0', 'a'), BASE, Resolution.pulled),  # moved in git
+    (NoteRecord('A.md', 'h0', 'a'), NoteRecord('b/A.md', 'h0', 'a'), BASE, Resolution.pushed),  # re-tagged
+    (NoteRecord('A.md', 'h1'), None, None, Resolution.pulled),  # never synced, i.e. new
+    (None, NoteRecord('A.md', 'h1', 'a'), None, Resolution.pushed),
+    (NoteRecord('A.md', 'h1', 'a'), NoteRecord('A.md', 'h2', 'a'), None, Resolution.conflict),
+))
+def test_resolve(source: NoteRecord | None, target: NoteRecord | None, base: NoteRecord | None,
+                 resolution: Resolution):
+    assert resolve(Change(ChangeType.modified, source, target), base) == resolution
+
+
+def test_note_index_cache(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setitem(configs, 'CACHE_DIR', tmp_path)
+    assert NoteIndex.load_cache().entries == {}
+    entry = {'id': '', 'alias': 'a', 'title': 'A', 'tags': ['Ä'], 'hash': 'h1'}
+    NoteIndex({'A.md': entry}).save_cache()  # type: ignore
+    cache = NoteIndex.load_cache()
+    assert cache.get('A.md', 'h1') == entry
+    assert cache.get('A.md', 'h2') is None  # changed since
+
+
+class FakeGitHelper:
+    def __init__(self, files: dict[str, str]) -> None:
+        self.files = files
+
+    def ls_files(self) -> dict[str, str]:
+        return {rel_path: hash_content(content) for rel_path, content in self.files.items()}
+
+    def read_text(self, rel_path: str) -> str:
+        if rel_path not in self.files:
+            raise FileNotFoundError(rel_path)
+        return self.files[rel_path]
+
+    def head(self) -> str:
+        return hash_content(repr(sorted(self.files.items())))
+
+    def write_file(self, rel_path: str, content: str) -> bool:
+        self.files[rel_path] = content
+        return True
+
+    def write_files(self, files: t.Iterable[tuple[str, str]]) -> list[str]:
+        return [rel_path for rel_path, content in files if self.write_file(rel_path, content)]
+
+    def remove_file(self, rel_path: str) -> None:
+        del self.files[rel_path]
+
+
+def test_single_user_skips_users_dir(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setitem(configs, 'CACHE_DIR', tmp_path)
+    monkeypatch.setattr(_helpers, 'git_helper', FakeGitHelper({
+        'a/A.md': 'A\n===\n',
+        '.hedge2git/users/b@example.com/B.md': 'B\n===\n',
+        '.hedge2git/users/b@example.com/.hedge2git/index': '',
+        'users/C.md': 'C\n===\n',
+    }))
+    assert list(_helpers.ls_notes()) == ['a/A.md', 'users/C.md']
+    assert list(_helpers.ls_notes(prefix := '.hedge2git/users/b@example.com/')) == [f'{prefix}B.md']
+    assert sorted(_helpers.scan_git_notes(NoteIndex())) == ['a/A.md', 'users/C.md']
+    rel_path = _helpers.gen_rel_path(['.hedge2git', 'users', 'b@example.com'], 'B')
+    assert rel_path == '_.hedge2git/users/b@example.com/B.md'  # never into the users pushed at once
+
+
+def test_push_removes_note_tagged_users(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    note = SimpleNamespace(
+        id=uuid.uuid4(), title='A', alias='users--a', content='###### tags: `users`\nA\n===\n',
+        updated_at=datetime.now().astimezone(),
+    )
+    notes = [note]
+    owner = SimpleNamespace(id=uuid.uuid4())
+    git_helper = FakeGitHelper({})
+    monkeypatch.setitem(configs, 'CACHE_DIR', tmp_path)
+    monkeypatch.setattr(_helpers, 'git_helper', git_helper)
+    monkeypatch.setattr(_helpers, 'hedgedoc', SimpleNamespace(
+        refresh_alias=lambda **kwargs: {},
+        iter_notes=lambda owner, updated_since: iter(notes),
+        get_contents=lambda note_ids: [(note.id, note.content) for note in notes if note.id in note_ids],
+        get_upload_names=lambda content: [],
+        get_uploads=lambda names: [],
+        get_note_ids=lambda owner: {str(note.id) for note in notes},
+    ))
+    _, state = _helpers.push_notes(owner, overwrite=True, dry_run=False)
+    state.save(git_helper.head())
+    assert 'users/A.md' in git_helper.files
+
+    notes.clear()
+    (tmp_path / 'state.json').unlink(missing_ok=True)  # a full sync
+    removed, _ = _helpers.push_notes(owner, overwrite=True, dry_run=False)
+    assert 'users/A.md' in removed and 'users/A.md' not in git_helper.files
+
+
+def test_export_history_patches_skipped_revisions(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    dmp = pytest.importorskip('diff_match_patch').diff_match_patch()
+    versions = [
+        'Alpha\n===\nline one\n',
+        'Alpha\n===\n###### tags: `secret`\nline one\ntwo\n',
+        'Alpha\n===\nline one\nthree\n',
+    ]
+    revisions = [
+        SimpleNamespace(
+            id=i, note_id='alpha', title='Alpha', created_at=datetime(2024, 1, 1 + i), authorship=None,
+            owner_id='', content=None, last_content=None, patch=dmp.patch_toText(dmp.patch_make(prev, version)),
+        )
+        for i, (prev, version) in enumerate(zip(['', *versions], versions))
+    ]
+    beta = SimpleNamespace(
+        id=9, note_id='beta', title='Beta', created_at=datetime(2024, 1, 2, 12), authorship=None, owner_id='',
+        content='Beta\n===\n', last_content=None, patch=None,
+    )
+    # the skipped revision precedes the watermark of the second run
+    runs = [[*revisions[:2], beta], revisions[2:]]
+    repo = git.Repo.init(tmp_path / 'repo')
+    remote = SimpleNamespace(push=lambda refspec: SimpleNamespace(raise_if_error=lambda: None))
+    monkeypatch.setattr(_helpers, 'git_helper', SimpleNamespace(
+        git_repo=repo, git_remote=remote, lock=threading.Lock(), repo_path=tmp_path / 'repo',
+        user_name='hedge2git', user_email='hedge2git@example.com',
+    ))
+    monkeypatch.setattr(_helpers, 'hedgedoc', SimpleNamespace(
+        get_current_user=lambda: None, get_users=lambda: [],
+        iter_revisions=lambda owner, since: iter(runs.pop(0)),
+    ))
+    monkeypatch.setitem(configs, 'CACHE_DIR', tmp_path / 'cache')
+    monkeypatch.setitem(configs, 'NOTE__DO_NOT_PUSH', ['secret'])
+    monkeypatch.setitem(configs, 'GIT_EMAIL', 'hedge2git@example.com')
+    _helpers.export_history(dry_run=False)
+    _helpers.export_history(dry_run=False)
+    log = repo.git.log('--format=%s', configs['GIT_HISTORY_REF']).splitlines()
+    assert log == ['Alpha', 'Beta', 'Alpha']  # the revision tagged secret is skipped
+    assert repo.git.show(f"{configs['GIT_HISTORY_REF']}:Alpha.md") + '\n' == versions[2]
+
+
+def test_sync_plan_round_trip(tmp_path: Path):
+    plan = SyncPlan('push', 'owner', overwrite=True, comment='Pushed', commit='c0ffee')
+    plan.writes.append({
+        'path': 'a/A.md', 'hash': 'h1', 'base': None,
+        'entry': {'id': 'note', 'alias': 'a--a', 'title': 'A', 'tags': ['a'], 'hash': 'h1'},
+    })
+    plan.removes.append({'path': 'A.md', 'base': 'h0'})
+    plan.notes = {'note': {'path': 'a/A.md', 'tags': ['a'], 'hash': 'h1', 'updated_at': ''}, 'gone': None}
+    plan.save(tmp_path / 'plan.json')
+    assert vars(SyncPlan.load(tmp_path / 'plan.json')) == vars(plan)
+    assert list(tmp_path.iterdir()) == [tmp_path / 'plan.json']
+
+
+def test_watch_survives_errors(monkeypatch: pytest.MonkeyPatch):
+    pushes: list[str] = []
+    removes: list[None] = []
+
+    def push(comment: str, *, overwrite: bool, dry_run: bool) -> None:
+        pushes.append(comment)
+        if len(pushes) == 1:
+            raise OSError('connection reset')
+
+    def wait_for_changes(timeout: float) -> None:
+        raise KeyboardInterrupt  # idle once pushed
+
+    monkeypatch.setattr(_helpers, 'push', push)
+    monkeypatch.setattr(_helpers, 'is_initialized', lambda git_helper: False)
+    monkeypatch.setattr(_helpers, 'hedgedoc', SimpleNamespace(
+        get_current_user=lambda: None,
+        session=SimpleNamespace(expunge=lambda obj: None, remove=lambda: removes.append(None)),
+        get_change_token=lambda owner: (1,),
+        wait_for_changes=wait_for_changes,
+        flush_history=lambda: None,
+    ))
+    _helpers.watch(overwrite=True, dry_run=False, interval=0, debounce=0)
+    assert len(pushes) == 2  # retried after the error
+    assert len(removes) == 3  # the session is released after every cycle, idle or not
+
+
+@pytest.mark.parametrize('overwrite', (False, True))
+def test_pull_plan_updates_need_overwrite(overwrite: bool, tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    owner = SimpleNamespace(id=uuid.uuid4())
+    note_id = str(uuid.uuid4())
+    monkeypatch.setitem(configs, 'CACHE_DIR', tmp_path)
+    monkeypatch.setattr(_helpers, 'git_helper', SimpleNamespace(pull=lambda: None))
+    monkeypatch.setattr(_helpers, 'hedgedoc', SimpleNamespace(get_current_user=lambda: owner))
+    monkeypatch.setattr(_helpers, 'scan_git_notes', lambda index: {
+        'x/A.md': {'id': note_id, 'alias': 'x--a', 'title': 'A', 'tags': ['x'], 'hash': 'h2'},
+    })
+    monkeypatch.setattr(_helpers, 'gen_hedgedoc_notes', lambda owner, state: iter([
+        NoteRecord('x/A.md', 'h1', note_id, 'x--a', ('x',)),
+    ]))
+    monkeypatch.setattr(_helpers, 'sync_notes', lambda *args, **kwargs: {})
+    plan = SyncPlan('pull', str(owner.id), overwrite=overwrite)
+    _helpers.pull(overwrite=overwrite, dry_run=True, plan=plan)
+    assert [update['path'] for update in plan.updates] == (['x/A.md'] if overwrite else [])  # else never applied
+
+
+def test_lock_dir(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(utils, 'dir_locks', {})
+    utils.lock_dir(tmp_path)
+    utils.lock_dir(tmp_path)  # held already
+    held = utils.dir_locks.pop(tmp_path)  # as if held by another run
+    with pytest.raises(SystemExit):
+        utils.lock_dir(tmp_path)
+    held.close()
+    utils.lock_dir(tmp_path)
+    utils.dir_locks[tmp_path].close()
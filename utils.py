@@ -1,9 +1,121 @@
+import contextlib
+import contextvars
+import fcntl
+import hashlib
 import sys
+import threading
+import time
 import typing as t
+from collections import Counter, defaultdict
+from concurrent.futures import Executor, Future
+from pathlib import Path
 
 import click
 
+T = t.TypeVar('T')
+
+timings: dict[str, float] = {}  # seconds spent in each phase, see timed
+counters: defaultdict[str, Counter[str]] = defaultdict(Counter)  # the counters of each phase, see count
+current_phase: contextvars.ContextVar[str] = contextvars.ContextVar('current_phase', default='')
+counters_lock = threading.Lock()
+dir_locks: dict[Path, t.IO[str]] = {}  # the lock files held until exit, see lock_dir
+
 
 def exit_with_error(msg: str) -> t.NoReturn:
     click.UsageError(msg, None).show(sys.stderr)
     exit(1)
+
+
+def lock_dir(path: Path) -> None:
+    """Hold an exclusive lock on a directory until exit, exiting if another process holds it."""
+    if path in dir_locks:
+        return
+    path.mkdir(parents=True, exist_ok=True)
+    lock_file = open(path / 'lock', 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)  # released by the OS however the process exits
+    except BlockingIOError:
+        lock_file.close()
+        exit_with_error(f'{path} is in use by another run, e.g. --watch')
+    dir_locks[path] = lock_file
+
+
+def hash_content(content: str | bytes) -> str:
+    """Return the git blob hash of a text or file, comparable with the git trees without reading the files."""
+    data = content.encode('utf-8') if isinstance(content, str) else content
+    return hashlib.sha1(b'blob %d\0' % len(data) + data, usedforsecurity=False).hexdigest()
+
+
+@contextlib.contextmanager
+def timed(phase: str) -> t.Iterator[None]:
+    """Accumulate the time spent in a phase into `timings`, also usable as a decorator.
+
+    A phase entered within another one is named after both, e.g. `push/git fetch`.
+    """
+    parent = current_phase.get()
+    phase = f'{parent}/{phase}' if parent else phase
+    token = current_phase.set(phase)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        current_phase.reset(token)
+        seconds = time.perf_counter() - start
+        with counters_lock:  # the same phase may be timed by many threads at once, e.g. the users pushed at once
+            timings[phase] = timings.get(phase, 0) + seconds
+            counters[phase]['calls'] += 1
+
+
+def count(counter: str, n: int = 1, *, phase: str | None = None) -> None:
+    """Add to a counter of the current phase, e.g. the SQL statements executed."""
+    with counters_lock:
+        counters[current_phase.get() if phase is None else phase][counter] += n
+
+
+def submit(executor: Executor, fn: t.Callable[..., T], *args: t.Any) -> Future[T]:
+    """Submit a call to an executor, so that it is timed and counted in the current phase."""
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+
+def get_report() -> dict[str, t.Any]:
+    """Return the time spent and the counters of each phase, and the counters summed over all phases."""
+    totals: Counter[str] = Counter()
+    for phase_counters in counters.values():
+        totals.update(phase_counters)
+    del totals['calls']
+    return {
+        'phases': {
+            phase or '(outside any phase)': {'seconds': timings.get(phase, 0), **counters[phase]}
+            for phase in sorted(timings.keys() | counters.keys(), key=lambda phase: (phase == '', phase))
+        },
+        'totals': dict(totals),
+    }
+
+
+class Lazy(t.Generic[T]):
+    """A proxy creating the object on first use, so that importing a singleton has no side effects."""
+
+    def __init__(self, factory: t.Callable[[], T], name: str) -> None:
+        object.__setattr__(self, '_factory', factory)
+        object.__setattr__(self, '_name', name)
+        object.__setattr__(self, '_obj', None)
+        object.__setattr__(self, '_lock', threading.Lock())
+
+    def _get(self) -> T:
+        if self._obj is None:
+            with self._lock:
+                if self._obj is None:
+                    with timed(f'init {self._name}'):
+                        object.__setattr__(self, '_obj', self._factory())
+        return self._obj  # type: ignore
+
+    def __getattr__(self, name: str) -> t.Any:
+        return getattr(self._get(), name)
+
+    def __setattr__(self, name: str, value: t.Any) -> None:
+        setattr(self._get(), name, value)
+
+
+def is_initialized(obj: t.Any) -> bool:
+    """Return whether a lazy singleton has been created."""
+    return not isinstance(obj, Lazy) or obj._obj is not None